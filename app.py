@@ -1,31 +1,203 @@
 import os
 import os.path
+import gzip
+import shutil
 import hashlib
+import gc
+import collections
 import json
-import re
 import logging
+import time
+import datetime
 import numpy
 import smtplib
 import email.mime.text
 import concurrent
 
+import tornado.concurrent
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.options
 import tornado.web
+import tornado.websocket
 import tornado.gen
+import tornado.queues
 import psycopg2
 import momoko
 
 import predictor
+import predictor.serialize
 
 tornado.options.define('port',
                        default=8080,
                        help='run on the given port',
                        type=int)
+tornado.options.define('processes',
+                       default=1,
+                       help='number of server processes forked after the models '
+                            + 'are loaded (0 forks one for each CPU)',
+                       type=int)
+tornado.options.define('debug',
+                       default=True,
+                       help='reload modified modules and show tracebacks '
+                            + '(turned off when processes are forked)',
+                       type=bool)
+tornado.options.define('prediction_processes',
+                       default=0,
+                       help='number of worker processes for prediction '
+                            + '(0 runs predictions on the thread pool)',
+                       type=int)
+tornado.options.define('claim_timeout',
+                       default=600,
+                       help='seconds after which a calculation claimed by '
+                            + 'another process is considered abandoned',
+                       type=int)
+tornado.options.define('hmm_cache_size',
+                       default=1024,
+                       help='number of sequences whose results are memoized '
+                            + 'by each model (0 disables it)',
+                       type=int)
+tornado.options.define('checkpoint_length',
+                       default=10000,
+                       help='length above which a sequence is decoded with '
+                            + 'checkpoints, in memory growing with its square root',
+                       type=int)
+tornado.options.define('db_pool_size',
+                       default=4,
+                       help='number of connections kept in the DB pool',
+                       type=int)
+tornado.options.define('db_pool_max_size',
+                       default=16,
+                       help='number of connections the DB pool may grow to',
+                       type=int)
+tornado.options.define('bulk_chunk_size',
+                       default=200,
+                       help='number of sequences predicted at a time by the bulk API',
+                       type=int)
+tornado.options.define('bulk_max_body_size',
+                       default=1024 ** 3,
+                       help='largest FASTA body (in bytes) accepted by the bulk API',
+                       type=int)
+tornado.options.define('result_ttl',
+                       default=90,
+                       help='days for which a calculated result is kept (0 keeps forever)',
+                       type=int)
+tornado.options.define('query_ttl',
+                       default=180,
+                       help='days for which a query (and its result) is kept '
+                            + 'since it was last submitted (0 keeps forever)',
+                       type=int)
+tornado.options.define('sequence_result_ttl',
+                       default=365,
+                       help='days for which the result of a sequence is cached '
+                            + '(0 keeps forever)',
+                       type=int)
+tornado.options.define('retention_interval',
+                       default=24,
+                       help='hours between runs of the retention job',
+                       type=int)
+tornado.options.define('smtp_host',
+                       default='localhost',
+                       help='host of the SMTP server',
+                       type=str)
+tornado.options.define('smtp_port',
+                       default=25,
+                       help='port of the SMTP server',
+                       type=int)
+tornado.options.define('mail_connections',
+                       default=2,
+                       help='number of SMTP connections used in parallel',
+                       type=int)
+tornado.options.define('batch_window',
+                       default=5,
+                       help='milliseconds for which predictions of concurrent '
+                            + 'requests are gathered into a batch',
+                       type=int)
+tornado.options.define('batch_max_residues',
+                       default=100000,
+                       help='number of residues which dispatches a batch '
+                            + 'before the window ends',
+                       type=int)
+tornado.options.define('stream_chunk_size',
+                       default=50,
+                       help='number of sequences predicted at a time '
+                            + 'while streaming results to the result page',
+                       type=int)
 
-class BaseHandler(tornado.web.RequestHandler):
-    """A Base class (for registering the db as property"""
+# PREPARE statements run on every connection of the DB pool (see prepare)
+PREPARED_STATEMENTS = []
+
+
+def prepare(name, types, statement):
+    """Register a statement prepared on every DB connection.
+
+    @param types  is a list of the types of the parameters ($1, $2, ...).
+    @return  the SQL executing the statement with psycopg2 placeholders."""
+    PREPARED_STATEMENTS.append(
+            "PREPARE {0} ({1}) AS {2};".format(name, ', '.join(types), statement))
+    return "EXECUTE {0} ({1});".format(name, ', '.join(['%s'] * len(types)))
+
+
+class MeasuredPool(object):
+    """MeasuredPool  a momoko.Pool which measures how long queries wait for a connection.
+
+    Only execute() and connect() of the pool are used by the app."""
+
+    def __init__(self, pool, size, max_size):
+        self.pool = pool
+        self.size = size
+        self.max_size = max_size
+        self.queries = 0
+        self.waiting = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # momoko.Pool gets the connection of every operation by
+        # self.getconn(), so wrapping it measures the waits while the pool
+        # keeps handling closed connections (reconnect and retry) itself
+        self.getconn = pool.getconn
+        pool.getconn = self.measured_getconn
+
+    def connect(self):
+        return self.pool.connect()
+
+    def execute(self, operation, parameters=()):
+        """Execute operation on a connection of the pool."""
+        return self.pool.execute(operation, parameters)
+
+    def measured_getconn(self, *args, **kwargs):
+        """Get a connection as pool.getconn does, measuring the wait."""
+        started = time.monotonic()
+        self.waiting += 1
+
+        def got(future):
+            waited = time.monotonic() - started
+            self.waiting -= 1
+            self.queries += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+        try:
+            future = self.getconn(*args, **kwargs)
+        except Exception:
+            self.waiting -= 1
+            raise
+        future.add_done_callback(got)
+        return future
+
+    def stats(self):
+        """Return a dictionary of the pool size and the waits (seconds)."""
+        return {'size': self.size,
+                'max_size': self.max_size,
+                'queries': self.queries,
+                'waiting': self.waiting,
+                'mean_wait': self.total_wait / max(self.queries, 1),
+                'max_wait': self.max_wait}
+
+
+class ApplicationMixin(object):
+    """A mixin for registering the db (and other members of the app) as property"""
     @property
     def db(self):
         return self.application.db
@@ -36,12 +208,385 @@ class BaseHandler(tornado.web.RequestHandler):
 
     @property
     def mail(self):
-        return self.application.mail_connection
+        return self.application.mailer
 
     @property
     def executor(self):
         return self.application.executor
 
+
+class BaseHandler(ApplicationMixin, tornado.web.RequestHandler):
+    """A Base class (for registering the db as property"""
+
+
+class Calculation(object):
+    """Calculation  a calculation of a query running in this process.
+
+    Requests for the same query share it: they wait for its future, and
+    listeners receive the rows reported so far as well as later ones."""
+
+    def __init__(self):
+        self.future = tornado.concurrent.Future()
+        self.total = None
+        self.rows = []
+        self.listeners = []
+
+    def listen(self, listener):
+        """Register listener(total, rows), replaying the rows reported so far."""
+        if len(self.rows) > 0:
+            listener(self.total, list(self.rows))
+        self.listeners.append(listener)
+
+    def report(self, total, rows):
+        """Record a list of (index, result) and pass it to the listeners."""
+        self.total = total
+        self.rows.extend(rows)
+        for listener in self.listeners:
+            listener(total, rows)
+
+class BatchScheduler(object):
+    """BatchScheduler  gathers the sequences of concurrent requests into batches.
+
+    Datasets submitted within window seconds (or until max_residues
+    residues are pending) are predicted as one job, and each caller's
+    future receives the result of its own dataset. Batch sizes and queue
+    wait times are logged for every batch and summarized by stats()."""
+
+    def __init__(self, dispatch, window=0.005, max_residues=100000):
+        """Constructor.
+
+        @param dispatch  takes a list of datasets and returns a future of the
+                         list of their results (e.g. of predict_many).
+        @param window  is the longest time (in seconds) a dataset waits for
+                       others to join its batch.
+        @param max_residues  dispatches the batch at once when the pending
+                             datasets have this many residues."""
+        self.dispatch = dispatch
+        self.window = window
+        self.max_residues = max_residues
+        self.pending = []  # (dataset, future, enqueued time)
+        self.pending_residues = 0
+        self.timeout = None
+        self.batches = 0
+        self.requests = 0
+        self.sequences = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, dataset):
+        """Queue a dataset and return a future of its result."""
+        future = tornado.concurrent.Future()
+        self.pending.append((dataset, future, time.monotonic()))
+        self.pending_residues += sum(len(seq.sequence) for seq in dataset)
+        if self.pending_residues >= self.max_residues:
+            self.flush()
+        elif self.timeout is None:
+            self.timeout = tornado.ioloop.IOLoop.current().call_later(
+                    self.window, self.flush)
+        return future
+
+    def flush(self):
+        """Dispatch the pending datasets as one batch."""
+        ioloop = tornado.ioloop.IOLoop.current()
+        if self.timeout is not None:
+            ioloop.remove_timeout(self.timeout)
+            self.timeout = None
+        batch = self.pending
+        residues = self.pending_residues
+        self.pending = []
+        self.pending_residues = 0
+        if len(batch) == 0:
+            return
+
+        now = time.monotonic()
+        waits = [now - enqueued for dataset, future, enqueued in batch]
+        sequences = sum(len(dataset.identifiers) for dataset, future, enqueued in batch)
+        self.batches += 1
+        self.requests += len(batch)
+        self.sequences += sequences
+        self.total_wait += sum(waits)
+        self.max_wait = max(self.max_wait, max(waits))
+        logging.info('dispatching a batch of %d requests (%d seqs, %d residues), '
+                     + 'longest queue wait %.1f ms',
+                     len(batch), sequences, residues, max(waits) * 1000)
+
+        try:
+            job = self.dispatch([dataset for dataset, future, enqueued in batch])
+        except Exception as error:
+            self.deliver(batch, error=error)
+        else:
+            ioloop.add_future(job, lambda job: self.deliver(batch, job=job))
+
+    def deliver(self, batch, job=None, error=None):
+        """Pass each result (or the error) of a batch to its caller."""
+        if job is not None:
+            try:
+                results = job.result()
+            except Exception as raised:
+                error = raised
+        for n, (dataset, future, enqueued) in enumerate(batch):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results[n])
+
+    def stats(self):
+        """Return a dictionary of the numbers of batches and requests,
+        the mean batch size and the mean and longest queue wait (seconds)."""
+        return {'batches': self.batches,
+                'requests': self.requests,
+                'sequences': self.sequences,
+                'mean_batch_size': self.requests / max(self.batches, 1),
+                'mean_wait': self.total_wait / max(self.requests, 1),
+                'max_wait': self.max_wait}
+
+
+class RetentionJob(object):
+    """RetentionJob  deletes expired rows and compacts old results.
+
+    Every run deletes, batch by batch, the results calculated more than
+    result_ttl days ago, the queries not submitted for query_ttl days
+    (with their results), the sequence results older than
+    sequence_result_ttl days and the results never calculated whose claim
+    is missing or older than claim_timeout seconds (abandoned or failed
+    calculations). Results stored as JSON before they were packed are
+    packed as well. A TTL of 0 disables the deletion."""
+    expire_results = prepare('expire_results', ['integer', 'integer'],
+            "WITH expired AS (DELETE FROM results WHERE id IN ("
+            + "SELECT id FROM results WHERE calculated < current_date - $1 "
+            + "LIMIT $2) RETURNING id) "
+            + "SELECT count(*) FROM expired")
+    expire_queries = prepare('expire_queries', ['integer', 'integer'],
+            "WITH expired AS (DELETE FROM queries WHERE id IN ("
+            + "SELECT id FROM queries WHERE created_date < current_date - $1 "
+            + "LIMIT $2) RETURNING id), "
+            + "orphans AS (DELETE FROM results WHERE id IN "
+            + "(SELECT id FROM expired) RETURNING id) "
+            + "SELECT count(*) FROM expired")
+    expire_sequence_results = prepare('expire_sequence_results',
+            ['integer', 'integer'],
+            "WITH expired AS (DELETE FROM sequence_results WHERE id IN ("
+            + "SELECT id FROM sequence_results "
+            + "WHERE created_date < current_date - $1 LIMIT $2) RETURNING id) "
+            + "SELECT count(*) FROM expired")
+    expire_claims = prepare('expire_claims', ['integer', 'integer'],
+            "WITH expired AS (DELETE FROM results WHERE id IN ("
+            + "SELECT id FROM results WHERE calculated IS NULL "
+            + "AND (claimed_at IS NULL "
+            + "OR claimed_at < now() - $1 * interval '1 second') "
+            + "LIMIT $2) RETURNING id) "
+            + "SELECT count(*) FROM expired")
+    select_unpacked = prepare('select_unpacked', ['integer'],
+            "SELECT id, result FROM results WHERE result IS NOT NULL LIMIT $1")
+    pack_result = prepare('pack_result', ['bytea', 'varchar'],
+            "UPDATE results SET packed = $1, result = null WHERE id = $2")
+
+    def __init__(self, db, result_ttl=90, query_ttl=180,
+                 sequence_result_ttl=365, claim_timeout=600,
+                 batch_size=1000):
+        """Constructor.
+
+        @param db  is the pool of the application.
+        @param claim_timeout  is the claim_timeout of the application.
+        @param batch_size  is the number of rows deleted (or packed) by a
+                           statement, so that no statement runs for long."""
+        self.db = db
+        self.result_ttl = result_ttl
+        self.query_ttl = query_ttl
+        self.sequence_result_ttl = sequence_result_ttl
+        self.claim_timeout = claim_timeout
+        self.batch_size = batch_size
+        self.running = False
+        self.last_run = {}
+
+    def start(self, interval):
+        """Run the job now and every interval seconds on the current IOLoop."""
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+        self.periodic = tornado.ioloop.PeriodicCallback(self.run, interval * 1000)
+        self.periodic.start()
+
+    @tornado.gen.coroutine
+    def run(self):
+        """Delete the expired rows and pack the results stored as JSON."""
+        if self.running:
+            return
+        self.running = True
+        counts = {}
+        try:
+            for name, statement, ttl in (
+                    ('results', self.expire_results, self.result_ttl),
+                    ('queries', self.expire_queries, self.query_ttl),
+                    ('sequence_results', self.expire_sequence_results,
+                     self.sequence_result_ttl),
+                    ('claims', self.expire_claims, self.claim_timeout)):
+                counts[name] = 0
+                while ttl > 0:
+                    cursor = yield self.db.execute(statement,
+                                                   (ttl, self.batch_size))
+                    deleted = cursor.fetchone()[0]
+                    counts[name] += deleted
+                    if deleted < self.batch_size:
+                        break
+            counts['packed'] = yield self.pack_results()
+            logging.info('retention job: deleted %d results, %d queries, '
+                         + '%d sequence results and %d abandoned claims, '
+                         + 'packed %d results',
+                         counts['results'], counts['queries'],
+                         counts['sequence_results'], counts['claims'],
+                         counts['packed'])
+        except (psycopg2.Warning, psycopg2.Error):
+            logging.exception('retention job failed')
+        finally:
+            self.last_run = dict(counts, finished=time.time())
+            self.running = False
+
+    @tornado.gen.coroutine
+    def pack_results(self):
+        """Pack the results stored as JSON (in the compact form), batch by batch."""
+        packed = 0
+        while True:
+            cursor = yield self.db.execute(self.select_unpacked,
+                                           (self.batch_size,))
+            rows = cursor.fetchall()
+            for query_id, result in rows:
+                compact = [predictor.serialize.compact_result(r) for r in result]
+                yield self.db.execute(self.pack_result, (
+                        predictor.serialize.pack(json.dumps(compact)), query_id))
+            packed += len(rows)
+            if len(rows) < self.batch_size:
+                return packed
+
+
+class MailQueue(object):
+    """MailQueue  sends e-mails in the background.
+
+    Handlers put messages by send() and return at once. Each of the
+    sender coroutines takes up to batch_size messages at a time and
+    delivers them on the executor over its own SMTP connection, which is
+    kept open between batches (and closed after idle_timeout seconds).
+    Failed messages are retried with exponential backoff."""
+
+    def __init__(self, executor, host='localhost', port=25, connections=2,
+                 batch_size=20, max_attempts=5, backoff=1.0,
+                 idle_timeout=60.0, timeout=30.0):
+        """Constructor.
+
+        @param executor  runs the blocking smtplib calls.
+        @param connections  is the number of senders (and SMTP connections).
+        @param max_attempts  is the number of attempts before giving up.
+        @param backoff  is the delay (seconds) before the first retry,
+                        doubled for every further attempt."""
+        self.executor = executor
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.queue = tornado.queues.Queue()
+        self.sent = 0
+        self.failed = 0
+
+    def start(self, ioloop):
+        """Start the senders on ioloop."""
+        for n in range(self.connections):
+            ioloop.spawn_callback(self.run)
+
+    def send(self, message):
+        """Queue an email.message.Message; 'from' and 'to' are required."""
+        self.queue.put_nowait((message, 0))
+
+    @tornado.gen.coroutine
+    def run(self):
+        """Deliver queued messages forever."""
+        connection = None
+        while True:
+            batch = []
+            try:
+                try:
+                    item = yield self.queue.get(
+                            timeout=datetime.timedelta(seconds=self.idle_timeout))
+                except tornado.gen.TimeoutError:
+                    if connection is not None:
+                        yield self.executor.submit(self.disconnect, connection)
+                        connection = None
+                    continue
+                batch = [item]
+                while len(batch) < self.batch_size and self.queue.qsize() > 0:
+                    batch.append(self.queue.get_nowait())
+                connection, failures = yield self.executor.submit(
+                        self.deliver, connection, batch)
+                self.sent += len(batch) - len(failures)
+                # the failures of the batch are retried below
+                batch = []
+                for message, attempts, error in failures:
+                    self.retry(message, attempts, error)
+            except Exception as error:
+                # a sender must never stop, or the queue is left undelivered
+                logging.exception('unexpected error in a mail sender')
+                connection = None
+                for message, attempts in batch:
+                    self.retry(message, attempts + 1, error)
+
+    def deliver(self, connection, batch):
+        """Send a batch over connection (opened if None).
+
+        This runs on the executor. A connection closed by the server is
+        reopened once before the message is considered failed.
+
+        @returns  (the connection or None, a list of (message, attempts, error)
+                  of the failed messages)"""
+        failures = []
+        for message, attempts in batch:
+            reused = connection is not None
+            while True:
+                try:
+                    if connection is None:
+                        connection = smtplib.SMTP(self.host, self.port,
+                                                  timeout=self.timeout)
+                    connection.sendmail(message['from'], [message['to']],
+                                        message.as_string())
+                except smtplib.SMTPRecipientsRefused as error:
+                    # retrying does not help
+                    failures.append((message, self.max_attempts, error))
+                except (smtplib.SMTPException, OSError) as error:
+                    connection = self.disconnect(connection)
+                    if reused:
+                        reused = False
+                        continue
+                    failures.append((message, attempts + 1, error))
+                except Exception as error:
+                    # e.g. UnicodeEncodeError of a non-ASCII address; the
+                    # transaction may be left open, so the connection too
+                    connection = self.disconnect(connection)
+                    failures.append((message, self.max_attempts, error))
+                break
+        return (connection, failures)
+
+    def disconnect(self, connection):
+        """Close a connection, ignoring errors. Returns None."""
+        if connection is not None:
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, OSError):
+                connection.close()
+        return None
+
+    def retry(self, message, attempts, error):
+        """Queue a failed message again after a delay, or give it up."""
+        if attempts >= self.max_attempts:
+            self.failed += 1
+            logging.error('gave up sending a mail to %s: %s', message['to'], error)
+            return
+        delay = self.backoff * 2 ** (attempts - 1)
+        logging.warning('failed to send a mail to %s (%s). retry in %.1f secs.',
+                        message['to'], error, delay)
+        tornado.ioloop.IOLoop.current().call_later(
+                delay, self.queue.put_nowait, (message, attempts))
+
+
 class TopPageHandler(BaseHandler):
     """TopPageHandler  """
 
@@ -58,8 +603,10 @@ class QueryHandler(BaseHandler):
     heavy calculations.
     """
 
-    select_statement = "SELECT 1 FROM queries WHERE id = %s;"
-    insert_statement = "INSERT INTO queries (id, seq, created_date) values (%s, %s, current_date);"
+    insert_statement = prepare('insert_query', ['varchar', 'text'],
+            "INSERT INTO queries (id, seq, created_date) "
+            + "values ($1, $2, current_date) "
+            + "ON CONFLICT (id) DO UPDATE SET created_date = current_date")
 
     @tornado.gen.coroutine
     def post(self):
@@ -74,14 +621,10 @@ class QueryHandler(BaseHandler):
         # register the query
         identifier = hashlib.sha256(query.encode('utf-8')).hexdigest()
         try:
-            cursor = yield self.db.execute(self.select_statement,
-                                            (identifier, ))
-            logging.info("try to retrieve the cached query: %s", self.select_statement % (identifier))
-            # if not registered, insert the data
-            if len(cursor.fetchall()) == 0:
-                cursor = yield self.db.execute(self.insert_statement,
-                                         (identifier, query,))
-                logging.info("register the query: %s", self.insert_statement % (identifier, '**',))
+            # a query registered before is kept (and not expired soon)
+            yield self.db.execute(self.insert_statement,
+                                  (identifier, query,))
+            logging.info("register the query: %s", self.insert_statement % (identifier, '**',))
         except (psycopg2.Warning, psycopg2.Error) as error:
             self.write(str(error))
         else:
@@ -90,94 +633,225 @@ class QueryHandler(BaseHandler):
         self.redirect("./result/{0}".format(identifier), status=303)
 
 
-class PredictHandler(BaseHandler):
-    """PredictHandler  handles requests from the result page and returns the result of prediction.
+class CalculationMixin(ApplicationMixin):
+    """CalculationMixin  calculates the result of a query for the handlers.
+
+    Concurrent requests for the same query are coalesced, so that a query
+    is calculated only once (see coalesced_calculation)."""
+    # returns the result if calculated already (packed, or as JSON if
+    # stored before packing). Otherwise, inserts a blank row or takes over
+    # a row whose claim is missing or older than the given seconds (only
+    # for an existing query, so that unknown ids add no rows), and returns
+    # whether it has been claimed, whether the query exists and the query.
+    claim_result = prepare('claim_result', ['varchar', 'integer'],
+            "WITH existing AS (SELECT result, packed, calculated "
+            + "FROM results WHERE id = $1), "
+            + "claimed AS (INSERT INTO results (id, claimed_at) SELECT $1, now() "
+            + "WHERE NOT EXISTS (SELECT 1 FROM existing WHERE calculated IS NOT NULL) "
+            + "AND EXISTS (SELECT 1 FROM queries WHERE id = $1) "
+            + "ON CONFLICT (id) DO UPDATE SET claimed_at = now() "
+            + "WHERE results.calculated IS NULL AND (results.claimed_at IS NULL "
+            + "OR results.claimed_at < now() - $2 * interval '1 second') "
+            + "RETURNING id) "
+            + "SELECT (SELECT packed FROM existing), "
+            + "(SELECT result FROM existing), "
+            + "EXISTS (SELECT 1 FROM claimed), "
+            + "EXISTS (SELECT 1 FROM queries WHERE id = $1), "
+            + "(SELECT seq FROM queries WHERE id = $1 "
+            + "AND EXISTS (SELECT 1 FROM claimed))")
+    release_claim = prepare('release_claim', ['varchar'],
+            "UPDATE results SET claimed_at = null where id = $1")
+    update_result = prepare('update_result', ['bytea', 'varchar'],
+            "UPDATE results SET packed = $1, calculated = current_date, "
+            + "claimed_at = null where id = $2 RETURNING mail_address")
+    select_sequence_results = prepare('select_sequence_results', ['varchar[]'],
+            "SELECT id, result FROM sequence_results WHERE id = ANY($1)")
+    insert_sequence_results = prepare('insert_sequence_results',
+            ['varchar[]', 'text[]'],
+            "INSERT INTO sequence_results (id, result, created_date) "
+            + "SELECT id, result::json, current_date "
+            + "FROM unnest($1, $2) AS computed (id, result) "
+            + "ON CONFLICT (id) DO NOTHING")
 
-    The Javascript function in the result page calls this handler, and return the result
-    in JSON format.
-    TODO: Long polling or WebSockets should be used to avoid redundunt calculations."""
-    select_query = "SELECT id, seq FROM queries WHERE id = %s;"
-    select_result = "SELECT id, result FROM results where id = %s;"
-    insert_result = "INSERT INTO results (id, result, mail_address, calculated) " \
-                    + "values (%s, null, null, null);"
-    update_result = "UPDATE results SET result = %s, calculated = current_date " \
-                    + "where id = %s;"
-    select_mail_address = "SELECT mail_address FROM results where id = %s"
-    tmd_re = re.compile(r'H+')
+    @tornado.gen.coroutine
+    def coalesced_calculation(self, query_id, listener=None):
+        """Calculate the result of query_id only once in this process.
+
+        The first request starts the calculation, and later requests for
+        the same query_id wait for the same future while it is running.
+
+        @param listener  is called as listener(total, rows) with a list of
+                         (index, result) whenever some results are ready
+                         (see Calculation and predict_sequences).
+                         Only a calculation started with a listener is
+                         predicted in chunks; otherwise all the sequences
+                         are predicted as one job, and a listener joining
+                         it receives the rows when it finishes."""
+        inflight = self.application.inflight
+        if query_id in inflight:
+            logging.info('Waiting for the running calculation. %s', query_id)
+            calculation = inflight[query_id]
+            if listener is not None:
+                calculation.listen(listener)
+            predicted_json = yield calculation.future
+            return predicted_json
+        calculation = Calculation()
+        if listener is not None:
+            calculation.listen(listener)
+        inflight[query_id] = calculation
+        future = calculation.future
+        # reporting in chunks costs a prediction job and an insert each,
+        # so it is only for the result page streaming the rows
+        report = calculation.report if listener is not None else None
+        try:
+            predicted_json = yield self.claimed_calculation(query_id, report)
+        except Exception as error:
+            future.set_exception(error)
+            # nobody may be waiting; mark the exception as retrieved
+            future.exception()
+            raise
+        else:
+            future.set_result(predicted_json)
+            return predicted_json
+        finally:
+            del inflight[query_id]
 
     @tornado.gen.coroutine
-    def get(self, query_id):
-        """Handles GET request from the result page.
+    def claimed_calculation(self, query_id, report=None):
+        """Calculate the result of query_id once among all app processes.
+
+        A process claims the query by setting results.claimed_at; the
+        others poll until the result is written. A claim older than
+        claim_timeout is considered abandoned and is taken over.
+        The cached result, if any, is returned by the same statement."""
+        while True:
+            cursor_c = yield self.db.execute(self.claim_result,
+                    (query_id, self.application.claim_timeout))
+            packed, result, claimed, found, query = cursor_c.fetchone()
+            if packed is not None:
+                logging.info('Found the cached result. %s', query_id)
+                return predictor.serialize.unpack(packed)
+            if result is not None:
+                logging.info('Found the cached result. %s', query_id)
+                return json.dumps(result)
+            if not found:
+                logging.error("No query found. %s", query_id)
+                raise tornado.web.HTTPError(404)
+            if claimed:
+                break
+            yield tornado.gen.sleep(self.application.claim_poll_interval)
+        logging.debug('claimed the calculation (id: %s)', query_id)
 
-        @param query_id  as a GET parameter, which should be the hash-key for the query.
-        @returns  prediction result in JSON format.
-        """
         try:
-            # fetch the cached result
-            cursor_r = yield self.db.execute(self.select_result,
-                                     (query_id, ))
-            results = cursor_r.fetchall()
-
-            if len(results) > 0 and results[0][1] is not None:
-                # results[0][1] should be the predicted result,
-                # so retruns the result if found.
-                logging.info('Found the cached result. %s' % (query_id,))
-                self.write(json.dumps(results[0][1]))
-            else:
+            predicted_json = yield self.calculate(query_id, query, report)
+        except Exception:
+            # let another request retry the calculation
+            yield self.db.execute(self.release_claim, (query_id,))
+            raise
+        return predicted_json
 
-                # retrieve query
-                cursor_q = yield self.db.execute(self.select_query,
-                                         (query_id, ))
-                queries = cursor_q.fetchall()
-                if len(queries) == 0 or len(queries[0]) == 0:
-                    logging.error("No query found.")
-                    # TODO: should forward to some cool error page.
-                query = queries[0][1]
-                logging.info('retrieve the query : %s', self.select_query % (query_id,))
-
-                # insert blank data
-                if len(results) == 0:
-                    yield self.db.execute(self.insert_result,
-                                    (query_id, ))
-                    logging.debug('inserted blank result data (id: %s)', query_id)
-
-                # create object and predict
-                query_data = self.dataset_maker.read_from_string(query)
-                # perform prediction
-                logging.debug('start calculation')
-                predicted = yield self.executor.submit(
-                        self.application.myhmm.predict,
-                        query_data, True)  # The 3rd boolean is whether the query is inverted or not
-                logging.debug('TA protein model prediction completed')
-                predicted_mp = yield self.executor.submit(
-                        self.application.mphmm.predict,
-                        query_data, False)
-                logging.debug('Multi-pass model prediction completed')
-
-                predicted_json = json.dumps(self.convert_result_data(predicted, predicted_mp, query_data))
-                logging.info('calculation finished: %s', predicted_json[:100] + '...')
-
-                # after calculation has been finished, update the table
-                yield self.db.execute(self.update_result,
-                                (predicted_json, query_id,))
-                logging.info('updated the result: %s',
-                        self.update_result % (predicted_json[:100] + '...', query_id,))
-
-                # see if an e-mail address has been registered or not
-                cursor_m = yield self.db.execute(self.select_mail_address,
-                                           (query_id,))
-                logging.info('See if there are email address registered: %s',
-                        self.select_mail_address % (query_id, ))
-                mail_address = cursor_m.fetchall()
-
-                if len(mail_address) > 0 and mail_address[0][0] is not None:  # there are mail address registered
-                    logging.info('found the email address. Sending the mail that notifies completion of the prediction (to %s).', str(mail_address))
-                    self.send_completion_mail(query_id, mail_address[0][0])
-
-                self.write(predicted_json)
-        except (psycopg2.Warning, psycopg2.Error) as error:
-            self.write(str(error))
+    @tornado.gen.coroutine
+    def calculate(self, query_id, query, report=None):
+        """Predict the query, store the result and send the mail if registered.
+
+        @param query  is the FASTA string of query_id (None if not found)."""
+        if query is None:
+            logging.error("No query found. %s", query_id)
+            # TODO: should forward to some cool error page.
+            raise tornado.web.HTTPError(404)
+
+        # create object and predict
+        query_data = self.dataset_maker.read_from_string(query)
+        # perform prediction
+        logging.debug('start calculation')
+        predicted = yield self.predict_sequences(query_data, report)
+        logging.debug('TA protein and multi-pass model prediction completed')
+
+        predicted_json = json.dumps(predicted)
+        logging.info('calculation finished: %s', predicted_json[:100] + '...')
+
+        # after calculation has been finished, update the table
+        # (which also tells whether an e-mail address has been registered)
+        cursor_m = yield self.db.execute(self.update_result,
+                        (predictor.serialize.pack(predicted_json), query_id,))
+        logging.info('updated the result: %s',
+                self.update_result % (predicted_json[:100] + '...', query_id,))
+        mail_address = cursor_m.fetchall()
+
+        if len(mail_address) > 0 and mail_address[0][0] is not None:  # there are mail address registered
+            logging.info('found the email address. Sending the mail that notifies completion of the prediction (to %s).', str(mail_address))
+            self.send_completion_mail(query_id, mail_address[0][0])
+
+        return predicted_json
 
+    @tornado.gen.coroutine
+    def predict_sequences(self, query_data, report=None):
+        """Predict every sequence in query_data, reusing per-sequence results.
+
+        Each sequence's converted result is cached in sequence_results
+        under a hash of its residues and the model version, so only the
+        sequences never seen before are calculated, and identical
+        sequences in a query are calculated once.
+
+        @param report  is called as report(total, rows) with a list of
+                       (index in query_data, result) as soon as results are
+                       available: first the cached ones, then the new ones
+                       every stream_chunk_size sequences.
+                       Without it, all the sequences are predicted at once.
+        @returns  a list of converted results in the order of query_data."""
+        keys = {}             # seq_id -> key of its residues
+        representatives = {}  # key -> the first seq_id having the residues
+        for seq in query_data:
+            key = self.application.sequence_key(seq.sequence)
+            keys[seq.identifier] = key
+            representatives.setdefault(key, seq.identifier)
+        positions = collections.defaultdict(list)  # key -> indices
+        for index, seq_id in enumerate(query_data.identifiers):
+            positions[keys[seq_id]].append(index)
+        total = len(query_data.identifiers)
+
+        def rows_of(found):
+            rows = [(index, dict(cached[key],
+                                 seq_id=query_data.identifiers[index]))
+                    for key in found for index in positions[key]]
+            rows.sort(key=lambda row: row[0])
+            return rows
+
+        cursor = yield self.db.execute(self.select_sequence_results,
+                                       (list(representatives.keys()),))
+        # results stored before the compact form are converted on the fly
+        cached = {key: predictor.serialize.compact_result(result)
+                  for key, result in cursor.fetchall()}
+        missing = [seq_id for key, seq_id in representatives.items()
+                   if key not in cached]
+        logging.info('%d of %d distinct sequences found in the cache',
+                     len(representatives) - len(missing), len(representatives))
+
+        if report is not None and len(cached) > 0:
+            report(total, rows_of(cached))
+
+        chunk_size = len(missing)
+        if report is not None:
+            chunk_size = self.application.stream_chunk_size
+        for start in range(0, len(missing), max(chunk_size, 1)):
+            chunk = missing[start:start + chunk_size]
+            subset = query_data.copy(chunk)
+            predicted = yield self.application.submit_prediction(subset)
+            found = []
+            values = []
+            for converted in self.convert_result_data(
+                    predicted['ta'], predicted['mp'], subset):
+                key = keys[converted.pop('seq_id')]
+                cached[key] = converted
+                found.append(key)
+                values.append(json.dumps(converted))
+            yield self.db.execute(self.insert_sequence_results,
+                                  (found, values))
+            if report is not None:
+                report(total, rows_of(found))
+
+        return [dict(cached[keys[seq_id]], seq_id=seq_id)
+                for seq_id in query_data.identifiers]
 
     def async_predict(self, myhmm, dataset, reverse=True, callback=None):
         """Async wrapper for predict.
@@ -190,22 +864,27 @@ class PredictHandler(BaseHandler):
         JSON format, so make these values into native python values.
         And to render results by Transparency, they should be a list,
         not a dictionary (or object). So convert them to a list.
+        Paths and scores are stored in the compact form of
+        predictor.serialize (expand_result restores the verbose one).
 
         @param predicted  is a dictionary of the predicted result.
         predicted
         +[seq_id]
          +['path'] : str, decoded path
-         +['pathnum'] : list of numpy.int64
+         +['pathnum'] : numpy.ndarray of int64
          +['likelihood'] : numpy.float64
-         +['omega'] : list of numpy.float64. 
+         +['omega'] : numpy.ndarray of float64
 
         new_result
         [ {'seq_id': 'XXXXX',
-           'pathnum': [1, 2, 3, ... ],
-           'omega':   [0.123, 0.234, ...],
+           'state_runs': [[1, 1], [2, 1], [3, 120], ... ],
+           'omega_fixed': {'precision': 2, 'dtype': '<i2',
+                           'data': 'gv+h/...'},
            'likelihood': 0.123456,
-           'path': 'GGGGGGGGGGGG....',
+           'path_runs': [['G', 120], ['H', 20], ...],
            'likelihood_mp': -0.123456,
+           (likelihood, likelihood_mp and score are None, and is_ta is
+            False, for a sequence without valid residues)
            'tmd_start': 234,
            'tmd_end':   250,
            'is_ta': True,
@@ -215,30 +894,41 @@ class PredictHandler(BaseHandler):
         for seq_id, dic in predicted.items():
             converted = {}
             converted['seq_id'] = seq_id
-            converted['pathnum'] = [i.item() for i in dic['pathnum']]
-            converted['omega'] = [i.item() for i in dic['omega']]
-            converted['likelihood'] = dic['likelihood'].item()
-            converted['path'] = dic['path']
-            converted['likelihood_mp'] = predicted_mp[seq_id]['likelihood'].item()
-            # round the score to 5 digits
-            tmp_score = (converted['likelihood'] - converted['likelihood_mp']) / len(dic['path'])
-            converted['score'] = round(tmp_score, 5)
-            # calculate tmd start and end
-            m = self.tmd_re.search(dic['path'])
-            if m is None:
-                tmd_start, tmd_end = -1, -1
+            converted['path_runs'] = predictor.serialize.string_runs(dic['path'])
+            converted['state_runs'] = predictor.serialize.state_runs(dic['pathnum'])
+            omega_fixed = predictor.serialize.fixed_deltas(dic['omega'])
+            if omega_fixed is None:
+                converted['omega'] = dic['omega'].tolist()
+            else:
+                converted['omega_fixed'] = omega_fixed
+            if len(dic['path']) == 0:
+                # no valid residue (e.g. only X), so nothing to score
+                converted['likelihood'] = None
+                converted['likelihood_mp'] = None
+                converted['score'] = None
             else:
-                tmd_start, tmd_end = m.start(), m.end()
+                converted['likelihood'] = float(dic['likelihood'])
+                converted['likelihood_mp'] = float(predicted_mp[seq_id]['likelihood'])
+                # round the score to 5 digits
+                tmp_score = (converted['likelihood'] - converted['likelihood_mp']) / len(dic['path'])
+                converted['score'] = round(tmp_score, 5)
+            # tmd is the first run of H
+            tmd_start, tmd_end = predictor.serialize.first_run(
+                    converted['path_runs'], 'H')
             converted['tmd_start'] = tmd_start
             converted['tmd_end']   = tmd_end
-            converted['is_ta'] = converted['score'] >= self.application.threshold
+            converted['is_ta'] = converted['score'] is not None \
+                    and converted['score'] >= self.application.threshold
             # the original amino acid sequence
             converted['seq'] = query_data[seq_id].sequence
-            print(converted['seq'])
             new_result.append(converted)
         return new_result
 
-    @tornado.gen.coroutine
+    def expand_results(self, predicted_json):
+        """Return the JSON of the verbose results (see convert_result_data)."""
+        return json.dumps([predictor.serialize.expand_result(result)
+                           for result in json.loads(predicted_json)])
+
     def send_completion_mail(self, query_id, mail_address):
         """send an email that notifies the prediction has been completed."""
         body = """Dear user,
@@ -259,12 +949,184 @@ class PredictHandler(BaseHandler):
         msg['reply-to'] = 'choge@bi.a.u-tokyo.ac.jp'
         msg['subject'] = 'TA Protein Prediction finished (ID:' + query_id + ')'
 
-        self.mail.sendmail(msg['from'], [msg['to']], msg.as_string())
+        self.mail.send(msg)
+
+
+class PredictHandler(CalculationMixin, BaseHandler):
+    """PredictHandler  handles requests from the result page and returns the result of prediction.
+
+    The Javascript function in the result page calls this handler, and return the result
+    in JSON format. (PredictSocketHandler streams the same result.)"""
+
+    @tornado.gen.coroutine
+    def get(self, query_id):
+        """Handles GET request from the result page.
+
+        @param query_id  as a GET parameter, which should be the hash-key for the query.
+        @param format  (optional) 'full' returns the verbose results with
+                       path, pathnum and omega instead of the compact ones.
+        @returns  prediction result in JSON format.
+        """
+        try:
+            # the cached result is returned if found
+            predicted_json = yield self.coalesced_calculation(query_id)
+            if self.get_argument('format', 'compact') == 'full':
+                predicted_json = self.expand_results(predicted_json)
+            self.write(predicted_json)
+        except (psycopg2.Warning, psycopg2.Error) as error:
+            self.write(str(error))
+
+
+class PredictSocketHandler(CalculationMixin, tornado.websocket.WebSocketHandler):
+    """PredictSocketHandler  streams the result of prediction to the result page.
+
+    Results are sent as soon as they become available, each message being
+    a JSON object such as
+      {'total': 120, 'done': 50, 'results': [[0, {...}], [1, {...}], ...]}
+    where [index, result] is a result of PredictHandler and the position of
+    the sequence in the query. The last message is
+      {'total': 120, 'done': 120, 'finished': true}
+    and then the connection is closed."""
+
+    def open(self, query_id):
+        self.sent = set()
+        self.total = None
+        tornado.ioloop.IOLoop.current().spawn_callback(self.stream, query_id)
+
+    @tornado.gen.coroutine
+    def stream(self, query_id):
+        """Send the results of query_id, calculating them if necessary."""
+        try:
+            predicted_json = yield self.coalesced_calculation(
+                    query_id, self.send_rows)
+            if self.total is not None and len(self.sent) == self.total:
+                predicted = []
+            else:
+                # cached or calculated by another process, nothing has been sent
+                predicted = json.loads(predicted_json)
+            self.send_rows(len(predicted) if self.total is None else self.total,
+                           list(enumerate(predicted)))
+            self.send_message({'total': self.total, 'done': len(self.sent),
+                               'finished': True})
+        except (psycopg2.Warning, psycopg2.Error) as error:
+            self.send_message({'error': str(error)})
+        finally:
+            self.close()
+
+    def send_rows(self, total, rows):
+        """Send a list of (index, result) which has not been sent yet."""
+        self.total = total
+        rows = [(index, result) for index, result in rows
+                if index not in self.sent]
+        if len(rows) == 0:
+            return
+        self.sent.update(index for index, result in rows)
+        self.send_message({'total': total, 'done': len(self.sent),
+                           'results': rows})
+
+    def send_message(self, message):
+        """Send a message unless the page has been closed."""
+        try:
+            self.write_message(json.dumps(message))
+        except tornado.websocket.WebSocketClosedError:
+            # the calculation goes on; its result is stored anyway
+            pass
+
+
+@tornado.web.stream_request_body
+class BulkPredictHandler(CalculationMixin, BaseHandler):
+    """BulkPredictHandler  predicts a large multi-FASTA body (e.g. a proteome).
+
+    The body is parsed while it is being uploaded, and every
+    bulk_chunk_size complete sequences are predicted and written back as
+    one JSON line per sequence (application/x-ndjson), e.g.
+      curl --data-binary @proteome.fasta http://<host>/tapp/api/predict
+    Reading the body waits while a chunk is predicted, so only a chunk of
+    sequences is held in memory regardless of the size of the upload."""
+
+    def prepare(self):
+        self.request.connection.set_max_body_size(
+                tornado.options.options.bulk_max_body_size)
+        self.feeder = predictor.FastaFeeder(self.dataset_maker.reader)
+        self.pending = []
+        self.predicted = 0
+        # an invalid body (or a failed prediction) is reported by post(),
+        # after the body has been read
+        self.error = None
+        self.error_status = 400
+        self.set_header('Content-Type', 'application/x-ndjson')
+
+    @tornado.gen.coroutine
+    def data_received(self, chunk):
+        self.parse(self.feeder.feed, chunk)
+        if len(self.pending) >= self.application.bulk_chunk_size:
+            yield self.predict_pending()
+
+    @tornado.gen.coroutine
+    def post(self):
+        """Predict the rest of the body.
+
+        @param format  (optional) 'full' as in PredictHandler.
+        @returns  a line of the result of PredictHandler for each sequence.
+                  If the body turns out to be invalid (or the prediction
+                  fails) after some results have been sent, the last line
+                  is {"error": message}."""
+        self.parse(self.feeder.close)
+        if self.error is None:
+            yield self.predict_pending()
+        if self.error is None:
+            return
+        if self.predicted == 0:
+            raise tornado.web.HTTPError(self.error_status, self.error)
+        self.write(json.dumps({'error': self.error}) + "\n")
+
+    def parse(self, method, *args):
+        """Add the records returned by a method of the feeder to pending.
+
+        The first error is kept in self.error, and the rest of the body
+        is ignored after it."""
+        if self.error is not None:
+            return
+        try:
+            records = method(*args)
+            # headers are parsed lazily; parse them here to find errors
+            for record in records:
+                record.identifier
+        except (ValueError, predictor.fasta.InvalidValueWarning) as error:
+            self.error = str(error)
+            self.pending = []
+            return
+        self.pending.extend(records)
+
+    @tornado.gen.coroutine
+    def predict_pending(self):
+        """Predict the sequences parsed so far and send their results."""
+        records = self.pending
+        self.pending = []
+        if len(records) == 0:
+            return
+        query_data = self.dataset_maker.data_type(records, name='bulk',
+                                                  origin='bulk')
+        try:
+            predicted = yield self.predict_sequences(query_data)
+        except Exception as error:
+            # the rest of the body is ignored, and post() reports the error
+            logging.exception('failed to predict a chunk of the bulk API')
+            self.error = 'prediction failed: %s' % error
+            self.error_status = 500
+            return
+        self.predicted += len(predicted)
+        if self.get_argument('format', 'compact') == 'full':
+            predicted = [predictor.serialize.expand_result(result)
+                         for result in predicted]
+        self.write(''.join(json.dumps(result) + "\n" for result in predicted))
+        yield self.flush()
 
 
 class ResultPageHandler(BaseHandler):
     """ResultPageHandler"""
-    statement = "SELECT id, seq FROM queries WHERE id = %s;"
+    statement = prepare('select_query', ['varchar'],
+            "SELECT id, seq FROM queries WHERE id = $1")
 
     @tornado.gen.coroutine
     def get(self, result_id):
@@ -287,7 +1149,8 @@ class ResultPageHandler(BaseHandler):
 
 class EmailSendHandler(BaseHandler):
     """EmailSendHandler"""
-    statement = "UPDATE results SET mail_address = %s where id = %s"
+    statement = prepare('update_mail_address', ['varchar', 'varchar'],
+            "UPDATE results SET mail_address = $1 where id = $2")
 
     @tornado.gen.coroutine
     def post(self, query_id):
@@ -321,52 +1184,116 @@ class EmailSendHandler(BaseHandler):
         msg['reply-to'] = 'choge@bi.a.u-tokyo.ac.jp'
         msg['subject'] = 'TA Protein Prediction finished (ID:' + query_id + ')'
 
-        try:
-            self.mail.sendmail(msg['from'], [msg['to']], msg.as_string())
-        except smtplib.SMTPServerDisconnected as error:
-            logging.info('mail connection has been disconnected. Try to re-connect.')
-            self.application.mail_connection = smtplib.SMTP('localhost')
-            self.application.mail_connection.connect()
-            self.mail.sendmail(msg['from'], [msg['to']], msg.as_string())
-
-
-class DataDownloadHandler(BaseHandler):
-    """Download a file"""
-    
-    def get(self, filename):
-        """Download the data file"""
-        with open('static/datasets/' + filename) as f:
-            self.set_header('Content-Type', 'text/plain')
-            self.set_header('Content-Disposition', 
-                            'attachment; filename=' + filename + '')
-            self.write(f.read())
-        
+        self.mail.send(msg)
+
+
+class StatsHandler(BaseHandler):
+    """StatsHandler  returns the metrics of the DB pool, the batches of
+    predictions and the mail queue in JSON format."""
+
+    def get(self):
+        self.write(json.dumps({
+            'db': self.db.stats(),
+            'batches': self.application.scheduler.stats(),
+            'retention': self.application.retention.last_run,
+            'mail': {'queued': self.mail.queue.qsize(),
+                     'sent': self.mail.sent,
+                     'failed': self.mail.failed}}))
+
+
+def prepare_datasets(directory):
+    """Write the gzip variant (<name>.gz) of each FASTA file in directory
+    unless it is up to date, and return the ETags of the files and their
+    variants by absolute path."""
+    etags = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.fasta'):
+            continue
+        path = os.path.abspath(os.path.join(directory, filename))
+        compressed = path + '.gz'
+        if not os.path.exists(compressed) \
+                or os.path.getmtime(compressed) < os.path.getmtime(path):
+            with open(path, 'rb') as source, \
+                    gzip.GzipFile(compressed + '.tmp', 'wb', mtime=0) as target:
+                shutil.copyfileobj(source, target)
+            os.replace(compressed + '.tmp', compressed)
+        for variant in (path, compressed):
+            digest = hashlib.md5()
+            with open(variant, 'rb') as f:
+                for chunk in iter(lambda: f.read(64 * 1024), b''):
+                    digest.update(chunk)
+            etags[variant] = '"%s"' % digest.hexdigest()
+    return etags
+
+
+class DataDownloadHandler(tornado.web.StaticFileHandler):
+    """Download a file of static/datasets.
+
+    StaticFileHandler sends the file in chunks and handles Range and
+    If-None-Match requests. Clients accepting gzip receive the variant
+    written by prepare_datasets at startup (unless they ask for a range)."""
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = tornado.web.StaticFileHandler.validate_absolute_path(
+                self, root, absolute_path)
+        self.set_header('Vary', 'Accept-Encoding')
+        compressed = absolute_path + '.gz'
+        if 'gzip' in self.request.headers.get('Accept-Encoding', '') \
+                and 'Range' not in self.request.headers \
+                and compressed in self.application.dataset_etags:
+            self.set_header('Content-Encoding', 'gzip')
+            # validated again so that the size and the date are its own
+            return tornado.web.StaticFileHandler.validate_absolute_path(
+                    self, root, compressed)
+        return absolute_path
+
+    def compute_etag(self):
+        # hashed once at startup instead of reading the file every time
+        etag = self.application.dataset_etags.get(self.absolute_path)
+        if etag is None:
+            etag = tornado.web.StaticFileHandler.compute_etag(self)
+        return etag
+
+    def get_content_type(self):
+        return 'text/plain'
+
+    def set_extra_headers(self, path):
+        self.set_header('Content-Disposition',
+                        'attachment; filename=' + os.path.basename(path))
 
 
 class Application(tornado.web.Application):
     """Web app"""
     HOSTNAME = 'tenuto.bi.a.u-tokyo.ac.jp/tapp'
+    DATASETS_PATH = os.path.join(os.path.dirname(__file__), 'static', 'datasets')
     callbacks = {}
 
-    def __init__(self, ioloop):
+    def __init__(self, debug=True):
+        """Load everything the processes of the server can share.
+
+        The models are loaded (unless they run on prediction processes)
+        before the server forks, so that the forked processes share their
+        arrays by copy-on-write. The rest is set up by start_process."""
         # handlers bind paths and handlers
         handlers = [(r'/tapp/', TopPageHandler),
                     (r'/tapp/predict', QueryHandler),
                     (r'/tapp/predict/([\w\-]+)', PredictHandler),
+                    (r'/tapp/predict/([\w\-]+)/stream', PredictSocketHandler),
                     (r'/tapp/result/([\w\-]+)', ResultPageHandler),
                     (r'/tapp/mail/([\w\-]+)', EmailSendHandler),
-                    (r'/tapp/data/(\w+\.fasta)', DataDownloadHandler)]
-
-        # Postgresql, utils, mails
-        self.db = momoko.Pool(dsn = 'dbname=tapp user=tapp password=tapp'
-                                    + ' host=localhost port=5432',
-                              size = 1,
-                              ioloop = ioloop)
+                    (r'/tapp/api/predict', BulkPredictHandler),
+                    (r'/tapp/stats', StatsHandler),
+                    (r'/tapp/data/(\w+\.fasta)', DataDownloadHandler,
+                     {'path': self.DATASETS_PATH})]
 
         self.dataset_maker = predictor.FastaDataSetMaker()
-        self.mail_connection = smtplib.SMTP('localhost')
-        self.mail_connection.connect()
-        self.executor = concurrent.futures.ThreadPoolExecutor(10)
+        self.dataset_etags = prepare_datasets(self.DATASETS_PATH)
+        # calculations running in this process (by query id)
+        self.inflight = {}
+        self.claim_timeout = tornado.options.options.claim_timeout
+        self.claim_poll_interval = 1.0
+        self.stream_chunk_size = tornado.options.options.stream_chunk_size
+        self.bulk_chunk_size = tornado.options.options.bulk_chunk_size
 
         # paths
         current_file_path = os.path.dirname(__file__)
@@ -376,34 +1303,138 @@ class Application(tornado.web.Application):
         # Threshold which determines the prediction result
         # whether the query is a TA protein or not.
         self.threshold = -0.016722298135034733
-        self.myhmm = predictor.MyHmmPredictor(
-                filename=os.path.join(
-                    current_file_path, 'modelsFinal/ta4.xml'))
-        self.myhmm.set_decoder('TTHHHHHHHHHHHHHHHHHHHHHHHHHCCCCCGTT')
-        self.mphmm = predictor.MyHmmPredictor(
-                filename=os.path.join(
-                    current_file_path, 'modelsFinal/mp.xml'))
-        self.mphmm.set_decoder('SSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSGLLLLLLLLLLLLLLLLLLLLCCCCCHHHHHHHHHHHHHHHHHHHHHHHHH')
+        # The TA model reads the query inverted, the multi-pass one doesn't.
+        # Only the likelihood of the multi-pass one is used (for the score).
+        self.models = {
+            'ta': {'filename': os.path.join(current_file_path,
+                                            'modelsFinal/ta4.xml'),
+                   'decoder': 'TTHHHHHHHHHHHHHHHHHHHHHHHHHCCCCCGTT',
+                   'reverse': True,
+                   'cache_size': tornado.options.options.hmm_cache_size,
+                   'checkpoint_length': tornado.options.options.checkpoint_length},
+            'mp': {'filename': os.path.join(current_file_path,
+                                            'modelsFinal/mp.xml'),
+                   'decoder': 'SSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSSGLLLLLLLLLLLLLLLLLLLLCCCCCHHHHHHHHHHHHHHHHHHHHHHHHH',
+                   'reverse': False,
+                   'likelihood_only': True,
+                   'cache_size': tornado.options.options.hmm_cache_size,
+                   'checkpoint_length': tornado.options.options.checkpoint_length}}
+        self.model_version = self.compute_model_version()
+        if tornado.options.options.prediction_processes > 0:
+            # created by start_process; each of them loads the models
+            self.predictors = None
+        else:
+            self.predictors = predictor.load_predictors(self.models)
         tornado.web.Application.__init__(self,
                 handlers,
                 template_path=template_path,
                 static_path=static_path,
                 static_url_prefix='/tapp/static/',
-                debug=True)
+                debug=debug)
+
+    def start_process(self, ioloop):
+        """Set up what every process needs of its own (after forking):
+        the DB pool, the thread pool, the mail queue, the batch scheduler
+        and the prediction processes.
+
+        @returns  a future which is done when the DB pool is connected."""
+        # Postgresql, utils, mails
+        pool_size = tornado.options.options.db_pool_size
+        pool_max_size = max(tornado.options.options.db_pool_max_size, pool_size)
+        self.db = MeasuredPool(
+                momoko.Pool(dsn = 'dbname=tapp user=tapp password=tapp'
+                                  + ' host=localhost port=5432',
+                            size = pool_size,
+                            max_size = pool_max_size,
+                            setsession = PREPARED_STATEMENTS,
+                            ioloop = ioloop),
+                pool_size, pool_max_size)
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(10)
+        self.mailer = MailQueue(self.executor,
+                                host=tornado.options.options.smtp_host,
+                                port=tornado.options.options.smtp_port,
+                                connections=tornado.options.options.mail_connections)
+        self.mailer.start(ioloop)
+        self.retention = RetentionJob(
+                self.db,
+                result_ttl=tornado.options.options.result_ttl,
+                query_ttl=tornado.options.options.query_ttl,
+                sequence_result_ttl=tornado.options.options.sequence_result_ttl,
+                claim_timeout=tornado.options.options.claim_timeout)
+
+        processes = tornado.options.options.prediction_processes
+        if processes > 0:
+            # each worker process loads the models by itself
+            self.predictors = predictor.ProcessPoolHmmPredictor(
+                    self.models, processes)
+        self.scheduler = BatchScheduler(
+                self.dispatch_batch,
+                window=tornado.options.options.batch_window / 1000.0,
+                max_residues=tornado.options.options.batch_max_residues)
+        return self.db.connect()
+
+    def compute_model_version(self):
+        """Return a hash of everything a cached prediction depends on:
+        the model files, their decoders and directions, and the threshold."""
+        digest = hashlib.sha256()
+        for name in sorted(self.models.keys()):
+            spec = self.models[name]
+            with open(spec['filename'], 'rb') as f:
+                digest.update(f.read())
+            digest.update((name + spec['decoder']
+                           + str(spec['reverse'])).encode('utf-8'))
+        digest.update(repr(self.threshold).encode('utf-8'))
+        return digest.hexdigest()
+
+    def sequence_key(self, sequence):
+        """Return the key of a sequence in the sequence_results table."""
+        return hashlib.sha256(
+                (self.model_version + ':' + sequence).encode('utf-8')).hexdigest()
+
+    def submit_prediction(self, query_data):
+        """Queue a dataset for prediction with all the models.
+
+        The datasets of concurrent requests are predicted together
+        (see BatchScheduler).
+
+        @returns  a future of the dictionary of each model's result."""
+        return self.scheduler.submit(query_data)
+
+    def dispatch_batch(self, datasets):
+        """Start predicting a batch of datasets with all the models.
+
+        @returns  a future of the list of results, one for each dataset."""
+        if isinstance(self.predictors, predictor.ProcessPoolHmmPredictor):
+            return self.predictors.submit_many(datasets)
+        return self.executor.submit(self.predictors.predict_many, datasets)
 
 
 if __name__ == '__main__':
     tornado.options.parse_command_line()
-    # retreive IOLoop object
-    ioloop = tornado.ioloop.IOLoop.instance()
-    app = Application(ioloop)
+    processes = tornado.options.options.processes
+    # autoreload cannot restart forked processes
+    app = Application(debug=tornado.options.options.debug and processes == 1)
+    sockets = tornado.netutil.bind_sockets(tornado.options.options.port)
+    task_id = None
+    if processes != 1:
+        # keep the loaded models out of the garbage collector, which would
+        # otherwise write to (and so copy) their pages in every process
+        gc.freeze()
+        task_id = tornado.process.fork_processes(processes)
+
+    # retreive IOLoop object (after forking; it cannot be shared)
+    ioloop = tornado.ioloop.IOLoop.current()
 
     # for momoko
-    future = app.db.connect()
+    future = app.start_process(ioloop)
     ioloop.add_future(future, lambda f: ioloop.stop())
     ioloop.start()
     future.result()
+    if not task_id:
+        # only the first process cleans the database up
+        app.retention.start(tornado.options.options.retention_interval * 3600)
 
     http_server = tornado.httpserver.HTTPServer(app)
-    http_server.listen(tornado.options.options.port)
+    http_server.add_sockets(sockets)
     ioloop.start()
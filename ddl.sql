@@ -8,21 +8,44 @@
 -- psql -U tapp -d tapp -f ddl.sql
 -- -> Done!
 
+-- (existing databases are upgraded by the scripts in migrations/)
+
 -- cache for queries
+-- created_date is updated whenever the query is submitted again,
+-- and queries older than --query_ttl days are deleted (see RetentionJob).
 create table queries
 (   id varchar(512) constraint firstkey primary key,
     seq text not null,
     created_date date not null);
 
-create index query_index
-on queries (id);
+create index queries_created_date
+on queries (created_date);
 
 -- cache for results
+-- packed is the JSON document of the results compressed by
+-- predictor.serialize.pack; result holds the JSON of rows stored before
+-- (RetentionJob packs them). Results calculated more than --result_ttl
+-- days ago are deleted.
 create table results
 (   id varchar(512) primary key,
     result JSON,
+    packed bytea,
     mail_address varchar(512),
-    calculated timestamp);
+    calculated timestamp,
+    -- set while an app process is calculating the result
+    claimed_at timestamp);
+
+create index results_calculated
+on results (calculated);
+
+-- cache for the result of each sequence, shared among queries.
+-- id is sha256 of the model version and the residues (see
+-- Application.sequence_key), so that a change of the models or the
+-- threshold never returns stale results.
+create table sequence_results
+(   id varchar(64) primary key,
+    result JSON not null,
+    created_date date not null);
 
-create index result_index
-on results (id);
+create index sequence_results_created_date
+on sequence_results (created_date);
@@ -0,0 +1,31 @@
+-- per-sequence cache, claims of calculations, compact storage of results
+-- and indexes for the retention job
+-- psql -U tapp -d tapp -f migrations/001_compact_results.sql
+
+-- the primary keys are indexed already
+drop index if exists query_index;
+drop index if exists result_index;
+
+-- set while an app process is calculating the result
+alter table results add column if not exists claimed_at timestamp;
+
+-- cache for the result of each sequence, shared among queries
+-- (see ddl.sql)
+create table if not exists sequence_results
+(   id varchar(64) primary key,
+    result JSON not null,
+    created_date date not null);
+
+-- results compressed by predictor.serialize.pack; the rows in the result
+-- column are packed by the retention job of the app.
+alter table results add column if not exists packed bytea;
+
+-- expired rows are looked up by these dates
+create index if not exists queries_created_date
+on queries (created_date);
+
+create index if not exists results_calculated
+on results (calculated);
+
+create index if not exists sequence_results_created_date
+on sequence_results (created_date);
@@ -3,4 +3,4 @@
 
 from predictor.dataset_maker import *
 from predictor.method_hmm import *
-
+from predictor.pool import *
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""cache  is a small in-process memoization utility.
+
+LRUCache keeps at most a given number of entries, evicts the least
+recently used one, and counts hits and misses. It is shared by the
+threads of an executor, so every operation holds a lock.
+"""
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    """LRUCache  a bounded mapping with least-recently-used eviction."""
+
+    def __init__(self, size):
+        """Constructor.
+
+        @param size  is the maximum number of entries (must be positive)."""
+        if size <= 0:
+            raise ValueError("size must be positive.")
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """Return the value of key (marking it as recently used) or default."""
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entries."""
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all the entries (the counters are kept)."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Return a dictionary of the size, hits and misses."""
+        with self.lock:
+            return {'entries': len(self.entries), 'size': self.size,
+                    'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""codec  converts sequences into numerical arrays and back.
+
+A SequenceCodec holds a precomputed lookup table for its alphabet, so
+that a whole sequence is encoded into a uint8 array (or an array of states
+is decoded into a string) by a single NumPy indexing operation instead of
+a Python loop over characters.
+"""
+
+import warnings
+
+import numpy as np
+
+from . import fasta
+
+# Marks characters that are not in the alphabet.
+INVALID = 255
+
+
+class SequenceCodec(object):
+    """SequenceCodec  encodes strings over an alphabet into uint8 arrays.
+
+    The i-th character of the alphabet is encoded as i. The alphabet may
+    contain the same character more than once (e.g. a decoder of states),
+    in which case only decoding is meaningful."""
+
+    def __init__(self, alphabet, decode_only=False):
+        """Constructor.
+
+        @param alphabet  is a string of at most 255 ASCII characters, or of
+                         any length if decode_only.
+        @param decode_only  skips the table for encoding (e.g. a decoder of
+                            the states of a model), so that encode raises
+                            ValueError."""
+        if len(alphabet) == 0:
+            raise ValueError("alphabet must contain at least one character.")
+        if len(alphabet) >= INVALID and not decode_only:
+            raise ValueError("alphabet is too long: %d" % len(alphabet))
+        self.alphabet = alphabet
+        self.symbols = np.frombuffer(alphabet.encode('ascii'), dtype=np.uint8)
+        self.table = None
+        if decode_only:
+            return
+        self.table = np.full(256, INVALID, dtype=np.uint8)
+        # the first occurrence wins for a duplicated character
+        for i in range(len(alphabet) - 1, -1, -1):
+            self.table[self.symbols[i]] = i
+
+    def __len__(self):
+        """Return the size of the alphabet."""
+        return len(self.alphabet)
+
+    def encode(self, sequence, missing='ignore', name=''):
+        """Encode a string into a uint8 array.
+
+        @param missing  is 'ignore' (drop invalid characters with a warning)
+                        or 'error' (raise ValueError).
+        @param name  is used in the message of the warning."""
+        self.check_encodable()
+        raw = np.frombuffer(sequence.encode('ascii', 'replace'), dtype=np.uint8)
+        encoded = self.table[raw]
+        invalid = encoded == INVALID
+        if invalid.any():
+            self.report_invalid(raw[invalid], missing, name)
+            encoded = encoded[~invalid]
+        return encoded
+
+    def encode_many(self, residues, offsets, missing='ignore', names=None):
+        """Encode concatenated sequences in one operation.
+
+        @param residues  is a uint8 array of concatenated ASCII sequences.
+        @param offsets  is an int64 array; sequence i is
+                        residues[offsets[i]:offsets[i + 1]].
+        @param names  is a list of names used in warnings.
+        @return  (encoded, offsets) in the same layout."""
+        self.check_encodable()
+        encoded = self.table[residues]
+        invalid = encoded == INVALID
+        if invalid.any():
+            owners = np.searchsorted(offsets, np.flatnonzero(invalid),
+                                     side='right') - 1
+            for n in np.unique(owners):
+                self.report_invalid(
+                        residues[offsets[n]:offsets[n + 1]][
+                            invalid[offsets[n]:offsets[n + 1]]],
+                        missing, names[n] if names else '')
+            kept = np.concatenate(([0], np.cumsum(~invalid)))
+            offsets = kept[offsets]
+            encoded = encoded[~invalid]
+        return (encoded, offsets)
+
+    def check_encodable(self):
+        """Raise ValueError if the codec is only for decoding."""
+        if self.table is None:
+            raise ValueError("the codec is only for decoding.")
+
+    def report_invalid(self, characters, missing='ignore', name=''):
+        """Warn (or raise ValueError) about invalid characters of a sequence."""
+        found = ''.join(sorted(set(characters.tobytes().decode('ascii'))))
+        if missing == 'error':
+            raise ValueError("Invalid character: " + found)
+        warnings.warn(fasta.InvalidValueWarning(
+            "%d invalid character(s) (%s) found in %s" %
+            (len(characters), found, name or 'a sequence')))
+
+    def decode(self, states):
+        """Decode an array of indices into a string.
+
+        Indices out of the alphabet are dropped with a warning."""
+        states = np.asarray(states)
+        outside = (states < 0) | (states >= len(self.alphabet))
+        if outside.any():
+            warnings.warn(fasta.InvalidValueWarning(
+                "%d state(s) out of range (only %d states registered)." %
+                (outside.sum(), len(self.alphabet))))
+            states = states[~outside]
+        return self.symbols[states].tobytes().decode('ascii')
+
+    @staticmethod
+    def reverse(encoded):
+        """Return the reversed sequence as a view of encoded."""
+        return encoded[::-1]
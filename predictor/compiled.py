@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""compiled  caches GHMM XML models as binary arrays.
+
+compile_model parses a GHMM XML file once and stores the transition,
+emission and initial probabilities (and their logarithms) as .npy files
+in a directory next to it (<filename>.compiled), together with the
+SHA-256 of the XML file. load_model reuses the directory as long as the
+XML file has the same SHA-256, and memory-maps the arrays, so that
+processes loading the same model share its pages.
+
+Usage: python -m predictor.compiled model.xml
+"""
+
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import sys
+
+import numpy as np
+
+import predictor.hmm.util as hmmutil
+import predictor.viterbi as viterbi
+
+COMPILED_SUFFIX = '.compiled'
+COMPILED_VERSION = 'tapp-compiled-hmm 1'
+ARRAYS = ('t', 'e', 'i', 'log_t', 'log_e', 'log_i')
+
+
+def compiled_dirname(filename):
+    """Return the name of the directory of the compiled filename."""
+    return filename + COMPILED_SUFFIX
+
+
+def file_hash(filename):
+    """Return the SHA-256 of the content of filename."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compile_model(filename):
+    """Parse filename and write its compiled form next to it.
+
+    @return  a dictionary of the arrays (see ARRAYS) and 'sha256'. The arrays are returned even when the directory
+             cannot be written."""
+    (t, e, i) = hmmutil.load_ghmmxml(filename)
+    model = {'t': np.asarray(t, dtype=np.float64),
+             'e': np.asarray(e, dtype=np.float64),
+             'i': np.asarray(i, dtype=np.float64)}
+    for name in ('t', 'e', 'i'):
+        model['log_' + name] = viterbi.to_log(model[name])
+    model['sha256'] = file_hash(filename)
+    directory = compiled_dirname(filename)
+    # written aside and renamed, so that readers never see a partial model
+    temporary = '%s.%d.tmp' % (directory, os.getpid())
+    try:
+        os.makedirs(temporary)
+        for name in ARRAYS:
+            np.save(os.path.join(temporary, name + '.npy'), model[name])
+        with open(os.path.join(temporary, 'model.json'), 'w',
+                  encoding='utf-8') as f:
+            json.dump({'version': COMPILED_VERSION, 'sha256': model['sha256']},
+                      f)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.rename(temporary, directory)
+    except OSError:
+        # e.g. a read-only directory, or another process has just renamed
+        shutil.rmtree(temporary, ignore_errors=True)
+    return model
+
+
+def load_compiled(filename):
+    """Return the compiled model of filename, or None if it is missing,
+    of another version or compiled from another content of filename."""
+    directory = compiled_dirname(filename)
+    try:
+        with open(os.path.join(directory, 'model.json'), encoding='utf-8') as f:
+            model = json.load(f)
+        if model.pop('version', None) != COMPILED_VERSION:
+            return None
+        if model.get('sha256') != file_hash(filename):
+            return None
+        for name in ARRAYS:
+            model[name] = np.load(os.path.join(directory, name + '.npy'),
+                                  mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+    return model
+
+
+def load_model(filename):
+    """Return the compiled model of filename, compiling it if needed."""
+    model = load_compiled(filename)
+    if model is None:
+        model = compile_model(filename)
+    return model
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit(__doc__.strip().split('\n')[-1])
+    compiled = compile_model(sys.argv[1])
+    print(compiled_dirname(sys.argv[1]), compiled['sha256'])
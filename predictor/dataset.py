@@ -3,6 +3,8 @@
 
 import random
 import copy
+import numpy as np
+from . import codec
 from . import fasta
 
 
@@ -41,8 +43,8 @@ class DataSet(object):
 
     def __contains__(self, key):
         """keyが存在しているかを判定する。具体的にはidentifierで
-        判断する。"""
-        return key in self.identifiers
+        判断する。containerの辞書を使うので、O(1)で済む。"""
+        return key in self.container
 
     def __getitem__(self, key):
         """keyに対応するデータを取り出す。keyとして文字列(ID)または
@@ -52,7 +54,7 @@ class DataSet(object):
             return [self[k] for k in key]
         if isinstance(key, int):
             return self.container[self.identifiers[key]]
-        elif key in self.identifiers:
+        elif key in self.container:
             return self.container[key]
         else:
             raise IndexError(key + "に対応する値は存在しません。")
@@ -63,7 +65,8 @@ class DataSet(object):
         if isinstance(key, list) and isinstance(val, list):
             for i in range(len(key)):
                 self[key[i]] = val[i]
-        if key in self.identifiers:
+            return
+        if key in self.container:
             raise IndexError(key + "は既に存在しています。")
         elif not isinstance(val, self.data_type):
             print(type(val))
@@ -78,11 +81,12 @@ class DataSet(object):
         if isinstance(key, list) or isinstance(key, tuple):
             for k in key:
                 del(self[k])
-        if key in self.identifiers:
+            return
+        if key in self.container:
             self.identifiers.remove(key)
             del(self.container[key])
             self.seqnum -= 1
-        elif key < self.seqnum:
+        elif isinstance(key, int) and key < self.seqnum:
             del(self.container[self.identifiers[key]])
             del(self.identifiers[key])
             self.seqnum -= 1
@@ -239,23 +243,26 @@ class DataSet(object):
         データの種類が違うとき(e.g.アミノ酸配列と塩基配列)は
         エラーを出力する。
         複数のデータセットをマージしたい時はmerge_allを参照
-        IDは、self[key] = ...のところで自動的に追加されている。
-        たぶん配列の数も同じだと思う。。。"""
+        追加するIDをまとめて求めてから一括で登録するので、
+        O(len(self) + len(other))で済む。"""
         if self.data_type != other.data_type:
-            raise TypeError(other + "のデータの種類が違います。")
+            raise TypeError(str(other) + "のデータの種類が違います。")
         if verbose:
             print(self, other)
+        new_keys = []
         for key in other.identifiers:
-            if key in self.identifiers:
-                continue
+            if key not in self.container:
+                new_keys.append(key)
+                # 重複したIDが二重に登録されないようにする
+                self.container[key] = None
+        for key in new_keys:
+            if do_copy:
+                self.container[key] = copy.copy(other[key])
             else:
-                if do_copy:
-                    self[key] = copy.copy(other[key])
-                else:
-                    self[key] = other[key]
-                if key in other.labels:
-                    self.labels[key] = other.get_label(key)
-                #self.identifiers.append(key)
+                self.container[key] = other[key]
+            if key in other.labels:
+                self.labels[key] = other.get_label(key)
+        self.identifiers.extend(new_keys)
         self._calc_stat()
         if verbose: print(self)
 
@@ -264,8 +271,8 @@ class DataSet(object):
 
         return_new Trueの場合、新たなインスタンスとして返す。
         """
-        if not isinstance(others, list) or not isinstance(others, tuple):
-            raise TypeError(others + "はリストである必要があります。")
+        if not isinstance(others, (list, tuple)):
+            raise TypeError(str(others) + "はリストである必要があります。")
         if return_new:
             original = copy.deepcopy(self)
         else:
@@ -273,7 +280,7 @@ class DataSet(object):
         for dataset in others:
             original.merge(dataset)
         if return_new:
-            original
+            return original
 
     def set_name(self, name):
         """データセットに名前をつける。"""
@@ -310,9 +317,11 @@ class DataSet(object):
         return [self.get_label(id) for id in self.identifiers]
 
     def convert2num(self, charlist):
-        """文字列を数字にして返す。"""
-        char_dic = {charlist[i]:i for i in range(len(charlist))}
-        return [[char_dic[c] for c in seq] for seq in self]
+        """文字列を数字(uint8の配列)にして返す。charlistにない文字があれば
+        ValueErrorを投げる。"""
+        sequence_codec = codec.SequenceCodec(charlist)
+        return [sequence_codec.encode(seq.sequence, missing='error')
+                for seq in self]
 
 
 class FastaDataSet(DataSet):
@@ -349,6 +358,20 @@ class FastaDataSet(DataSet):
             self.labels = {}
             self.set_labels(0)
 
+    def sequence_columns(self):
+        """配列を列指向の形で返す。(identifiers, residues, offsets)の
+        タプルで、residuesは全配列を連結したuint8の配列、
+        offsetsはi番目の配列がresidues[offsets[i]:offsets[i + 1]]に
+        あることを表すint64の配列。"""
+        identifiers = list(self.identifiers)
+        seqs = [self.container[key].sequence.encode('ascii', 'replace')
+                for key in identifiers]
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum(np.array([len(seq) for seq in seqs], dtype=np.int64),
+                  out=offsets[1:])
+        residues = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+        return (identifiers, residues, offsets)
+
 
 class DNADataSet(DataSet):
     """DNADataSet DNA配列を扱うデータセット。
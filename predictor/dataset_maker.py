@@ -8,17 +8,25 @@ FastaReader is a module for reading objects from a file or a string,
 FastaBuilder is a module for creating data objects.
 DataSetMaker is a high-level module that creates dataset from its source.
 """
+import codecs
+import gzip
+import io
 import os.path
 import re
 
 from . import dataset
 from . import fasta
+from . import fasta_index
+
+GZIP_MAGIC = b'\x1f\x8b'
 
 
 class FastaReader( object ):
     """FastaUtil A utility class for fasta sequences.
 
-    hogehoge
+    Records are read one by one by the iter_* generators, so that memory
+    use depends only on the longest record. Files and binary streams may
+    be gzip-compressed.
     """
 
     def __init__(self, builder, protein=True):
@@ -30,52 +38,109 @@ class FastaReader( object ):
         """複数のfasta配列が入ってるファイルをパースして、
         Fastaオブジェクトのリストにして返す。とりあえず
         アミノ酸配列だけ対応したよ。"""
-        if os.path.exists( filename ):
-            f = open( filename, 'r' )
-        else:
-            raise ValueError(filename + " not found.")
+        return list(self.iter_file(filename))
 
-        seq = ''
-        fasta_list = []
-        #seq_num = 0
-        for line in f:
-            if line == '' or line == "\n" or line[0] == '#':
-                continue
-            elif len( seq ) > 0 and line[0] == '>':
-                #seq_num += 1
-                fasta_list.append( self.builder.create(seq) )
-                seq = line
-            else:
-                seq += line
-        ## Add the last line
-        fasta_list.append( self.builder.create(seq) )
-        return fasta_list
-    
     def parse_string(self, s, protein=True):
-        """TODO: codes below are duplicated as parse_file(), so needs refactoring"""
-        seq = ''
-        fasta_list = []
-        line_no = 0
-        for line in s.splitlines():
-            line_no += 1
-            #print(line_no, line)
-            if line == '' or line == "\n" or line[0] == '#':
+        """Parse a string and return a list of Fasta objects."""
+        return list(self.iter_string(s))
+
+    def iter_file(self, filename):
+        """Yield Fasta objects from a (possibly gzipped) file."""
+        if not os.path.exists( filename ):
+            raise ValueError(filename + " not found.")
+        with open( filename, 'rb' ) as f:
+            for record in self.iter_stream(f):
+                yield record
+
+    def iter_string(self, s):
+        """Yield Fasta objects from a string."""
+        return self.iter_lines(io.StringIO(s))
+
+    def iter_stream(self, stream):
+        """Yield Fasta objects from a text stream or a (possibly gzipped)
+        binary stream."""
+        if isinstance(stream, io.TextIOBase):
+            return self.iter_lines(stream)
+        if is_gzipped(stream):
+            stream = gzip.GzipFile(fileobj=stream)
+        return self.iter_lines(
+                io.TextIOWrapper(stream, encoding='utf-8', errors='replace'))
+
+    def iter_lines(self, lines):
+        """Yield Fasta objects from an iterable of lines."""
+        return self.builder.create_many(self.iter_records(lines))
+
+    def iter_records(self, lines):
+        """Yield each record as a string of its header line and sequence.
+
+        Empty lines and lines starting with '#' are skipped."""
+        header = None
+        seq = []
+        for line in lines:
+            line = line.strip()
+            if line == '' or line[0] == '#':
                 continue
-            elif len( seq ) > 0 and line[0] == '>':
-                #seq_num += 1
-                #print(len(fasta_list), seq)
-                fasta_list.append( self.builder.create(seq) )
-                seq = line + "\n"
             elif line[0] == '>':
-                # the first line
-                seq += line + "\n"
+                if header is not None:
+                    yield header + "\n" + ''.join(seq)
+                header = line
+                seq = []
+            elif header is None:
+                raise ValueError("No header line found before: " + line[:20])
             else:
-                seq += line
-        ## Add the last line
-        fasta_list.append( self.builder.create(seq) )
-        return fasta_list
+                seq.append(line)
+        ## Add the last record
+        if header is not None:
+            yield header + "\n" + ''.join(seq)
 
 
+class FastaFeeder(object):
+    """FastaFeeder  parses FASTA text given piece by piece.
+
+    feed() takes any fragment of the text (e.g. a chunk of an HTTP body)
+    and returns the Fasta objects completed by it, and close() returns the
+    rest. Only the last, possibly incomplete, record is buffered."""
+
+    def __init__(self, reader):
+        """Constructor.
+
+        @param reader  is a FastaReader which parses complete records."""
+        self.reader = reader
+        self.buffer = ''
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def feed(self, data):
+        """Add a fragment (str, or bytes of UTF-8) and return complete records."""
+        if isinstance(data, bytes):
+            data = self.decoder.decode(data)
+        self.buffer += data
+        # every record before the last header line is complete
+        end = self.buffer.rfind('\n>')
+        if end < 0:
+            return []
+        text, self.buffer = self.buffer[:end + 1], self.buffer[end + 1:]
+        return list(self.reader.iter_string(text))
+
+    def close(self):
+        """Return the records left in the buffer."""
+        text = self.buffer + self.decoder.decode(b'', final=True)
+        self.buffer = ''
+        return list(self.reader.iter_string(text))
+
+
+def is_gzipped(stream):
+    """Return True if a binary stream starts with the gzip magic number.
+
+    The stream is not consumed (it has to support peek() or seek())."""
+    if hasattr(stream, 'peek'):
+        return stream.peek(2)[:2] == GZIP_MAGIC
+    elif stream.seekable():
+        position = stream.tell()
+        head = stream.read(2)
+        stream.seek(position)
+        return head == GZIP_MAGIC
+    return False
+
 
 class FastaBuilder( object ):
     """FastaBuilder  is a module for creating data objects
@@ -89,7 +154,7 @@ class FastaBuilder( object ):
         self.regex = {} # 正規表現を持つ。
         self.prototypes = {} #
         self.default_prototype = default
-
+        self.dispatcher = None # 全正規表現をまとめたもの。
     def register(self, prototype_name, prototype, regex):
         """prototype_nameに対応するクラスと正規表現を
         登録する。すでに登録してある場合は、エラー。"""
@@ -101,20 +166,53 @@ class FastaBuilder( object ):
             raise TypeError(prototype + " is not a Fasta object.")
         self.prototypes[ prototype_name ] = prototype
         self.regex[ prototype_name ] = regex
+        self.dispatcher = None
+
+    def compile_dispatcher(self):
+        """登録された正規表現を、登録順に並べた一つの選択(alternation)に
+        まとめる。先に登録されたものほど優先される。
+
+        フラグ付きの正規表現や後方参照を含む正規表現はまとめられないので、
+        その場合はNoneを返し、一つずつ試す方式にする。"""
+        names = list(self.regex.keys())
+        for regex in self.regex.values():
+            if regex.flags & ~re.UNICODE or re.search(r'\\\d|\(\?P=', regex.pattern):
+                return None
+        try:
+            combined = re.compile('|'.join(
+                    '(?P<_%d>%s)' % (n, self.regex[name].pattern)
+                    for n, name in enumerate(names)))
+        except re.error:
+            return None
+        prototypes = {'_%d' % n: self.prototypes[name]
+                      for n, name in enumerate(names)}
+        return (combined, prototypes)
 
     def guess_database(self, unknown_str):
         """unknown_strがどのプロトタイプに適合するのかを
         判定し、適切なプロトタイプを返す。
 
         @unknown_str Fasta配列そのものを想定。"""
-        # 最初の行のみを取得
-        unknown_str = unknown_str.split("\n", 1)[0]
-        if len( unknown_str ) == 0:
+        # 最初の行の終わり(配列部分をコピーしないよう、位置だけ求める)
+        end = unknown_str.find("\n")
+        if end < 0:
+            end = len( unknown_str )
+        if end == 0:
             raise ValueError("Empty string.")
         elif unknown_str[0] != '>':
             raise ValueError("")
+        if self.regex and self.dispatcher is None:
+            self.dispatcher = self.compile_dispatcher() or False
+        if self.dispatcher:
+            # 一回のマッチで、どのプロトタイプかが決まる。
+            combined, prototypes = self.dispatcher
+            result = combined.match( unknown_str, 0, end )
+            if result:
+                return prototypes[ result.lastgroup ]
+            return self.default_prototype
+        header = unknown_str[:end]
         for prototype_name, regex in list(self.regex.items()):
-            result = regex.match( unknown_str )
+            result = regex.match( header )
             if result: # 正規表現がマッチした場合
                 return self.prototypes[ prototype_name ]
         # ここまで処理が流れてくると、どのプロトタイプにもマッチしなかった
@@ -127,6 +225,12 @@ class FastaBuilder( object ):
         prototype = self.guess_database(unknown_str)
         return prototype( unknown_str )
 
+    def create_many(self, unknown_strs):
+        """複数のFasta配列(文字列)からインスタンスを順に生成する
+        ジェネレータ。"""
+        for unknown_str in unknown_strs:
+            yield self.create( unknown_str )
+
     def new_class(self, classname, baseclass, attr, regex):
         """動的に新しいクラスを生成して、登録します。
 
@@ -146,6 +250,9 @@ class FastaBuilder( object ):
         for required_attr in required_attrs:
             if not required_attr in attr:
                 raise ValueError(required_attr + "は必須です。")
+        # インスタンスに__dict__を持たせないようにする。
+        attr = dict(attr)
+        attr.setdefault('__slots__', ())
         new_class = type( classname, baseclass, attr )
         self.register(classname, new_class, regex)
 
@@ -156,9 +263,7 @@ class ProteinFastaBuilder( FastaBuilder ):
 
     def __init__(self):
         """コンストラクタ"""
-        self.regex = {}
-        self.prototypes = {}
-        self.default_prototype = fasta.BasicProteinFasta
+        FastaBuilder.__init__(self, fasta.BasicProteinFasta)
 
         # nested classes cannot be pickled.
         # SwissProt
@@ -221,6 +326,42 @@ class DataSetMaker(object):
         data_list = self.reader.parse_string(s)
         return self.data_type(data_list, name=name, origin=name, labels=label)
 
+    def open_indexed(self, filename, name='', label=None):
+        """Open a FASTA file through its offset index (built if needed).
+
+        Records are parsed only when they are accessed."""
+        if not name:
+            name, ext = os.path.splitext( os.path.basename( filename ) )
+        return fasta_index.IndexedFastaDataSet(filename, self.reader,
+                                               name=name, origin=name,
+                                               labels=label)
+
+    def iter_from_file(self, filename, size=1000, name='', label=None):
+        """Read a (possibly gzipped) file and yield datasets of at most
+        size sequences, so that the whole file is never in memory."""
+        if not name:
+            name, ext = os.path.splitext( os.path.basename( filename ) )
+        return self.iter_chunks(self.reader.iter_file(filename),
+                                size, name, label)
+
+    def iter_from_stream(self, stream, size=1000, name='', label=None):
+        """Same as iter_from_file, but reads a text or binary stream."""
+        if not name:
+            name = 'test'
+        return self.iter_chunks(self.reader.iter_stream(stream),
+                                size, name, label)
+
+    def iter_chunks(self, records, size, name, label=None):
+        """Group records into datasets of at most size sequences."""
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= size:
+                yield self.data_type(chunk, name=name, origin=name, labels=label)
+                chunk = []
+        if chunk:
+            yield self.data_type(chunk, name=name, origin=name, labels=label)
+
     def read_from_sqlite(self, dbname, query, name=""):
         """SQLite3データベースから、データセットを作成する。
         dbnameとqueryは必須。"""
@@ -20,7 +20,14 @@ class Fasta(object, metaclass=abc.ABCMeta):
     ヘッダー行のパース、データベースへの接続などは
     サブクラスによって実装される。抽象クラスは、インスタンスを
     作れないクラスのことなので、メソッドを実装するのは問題ない
-    ・・・はず。"""
+    ・・・はず。
+
+    大量の配列を読み込むため、__slots__でインスタンスの__dict__を
+    なくしている。identifier、accession、organismは、最初にアクセス
+    されたときに初めてヘッダー行からパースされる。サブクラスでも
+    __slots__ = ()を定義すること。"""
+    __slots__ = ('header', 'sequence', 'seqlen', 'current_index',
+                 '_identifier', '_accession', '_organism')
     # ヘッダーをパースする際に用いる、正規表現オブジェクト。
     # 実際はサブクラスで定義されます。
     re_identifier = re.compile("")
@@ -62,10 +69,10 @@ class Fasta(object, metaclass=abc.ABCMeta):
         """コンストラクタです。
         Fasta形式そのままのテキストか、ヘッダーと配列部分を別々に
         要求します。"""
-        #print("sequence: {0}\nheader: {1}".format(sequence, header))
         # 引数の最初が'>'で始まっている＝ヘッダー行が含まれる
-        if sequence[0] == '>':
-            (self.header, self.sequence) = sequence.splitlines()
+        if sequence[:1] == '>':
+            (self.header, self.sequence) = (sequence.split("\n", 1) + [''])[:2]
+            self.header = self.header.rstrip("\r")
         elif header == "":
             raise ValueError("No header line found.")
         else:
@@ -74,11 +81,59 @@ class Fasta(object, metaclass=abc.ABCMeta):
 
         # (DNA|アミノ酸)配列中の改行文字を削除
         self.sequence = self.sequence.replace("\n", "")
-        # ヘッダー行をパース
-        self.parse_header()
+        # ヘッダー行は必要になるまでパースしない。
+        self._identifier = None
+        self._accession = None
+        self._organism = None
         # 配列の長さもセットしておく。
         self.seqlen = len(self.sequence)
 
+    @property
+    def identifier(self):
+        """識別子。最初のアクセス時にパースする。"""
+        if self._identifier is None:
+            self._identifier = self.parse_field('identifier')
+        return self._identifier
+
+    @identifier.setter
+    def identifier(self, value):
+        self._identifier = value
+
+    @property
+    def accession(self):
+        """アクセッション番号。最初のアクセス時にパースする。"""
+        if self._accession is None:
+            self._accession = self.parse_field('accession')
+        return self._accession
+
+    @accession.setter
+    def accession(self, value):
+        self._accession = value
+
+    @property
+    def organism(self):
+        """生物種。最初のアクセス時にパースする。"""
+        if self._organism is None:
+            self._organism = self.parse_field('organism')
+        return self._organism
+
+    @organism.setter
+    def organism(self, value):
+        self._organism = value
+
+    def parse_field(self, key, header=''):
+        """ヘッダー行からkeyに対応する値だけを取り出す。見つからない場合は
+        デフォルトの値を返す(identifierの場合はInvalidValueWarningを投げる)。"""
+        if header == "":
+            header = self.header
+        matches = getattr(self, 're_' + key).findall(header)
+        if len(matches) == 0:
+            if key == 'identifier':
+                raise InvalidValueWarning(
+                        "No " + key + " found in the header line: " + header)
+            return self.parser_default_values[key]
+        return matches[0]
+
     def __repr__(self):
         """公式の文字列を返します。実態はFASTA形式の文字列です"""
         return self.identifier
@@ -216,6 +271,7 @@ class ProteinFasta(Fasta, metaclass=abc.ABCMeta):
     このクラスも抽象クラスで、個々のサブクラスで具体的な実装が
     期待されています。
     また、このクラスはBやZのような曖昧な文字を許可しません。"""
+    __slots__ = ()
     valid_chars = "ACDEFGHIKLMNPQRSTVWY"
     invalid_chars = "BJOUXZ"
 
@@ -237,6 +293,7 @@ class ExProteinFasta(ProteinFasta, metaclass=abc.ABCMeta):
     このクラスも抽象クラスです。ProteinFastaクラスと異なり、
     このクラスのインスタンスはBやZのような曖昧な文字を配列中に
     持つことが出来ます。ただしJおよびO、Uは許可されません。"""
+    __slots__ = ()
     valid_chars = "ABCDEFGHIKLMNPQRSTVWXYZ"
 
     def is_valid_char(self, char):
@@ -248,6 +305,7 @@ class DNAFasta(Fasta, metaclass=abc.ABCMeta):
     """DNAFasta DNA配列を扱うためのクラス。
 
     このクラスも抽象クラス。"""
+    __slots__ = ()
 
     def is_valid_char(self, char):
         """charがDNA配列として正しい文字であるかどうかを判定する。
@@ -259,6 +317,7 @@ class BasicProteinFasta(ProteinFasta):
 
     このクラスは、特定のフォーマットに対応していないFasta配列を扱います。
     そのため、connect_dbおよびparse_headerの一部はサポートされていません。"""
+    __slots__ = ()
 
     re_identifier = re.compile("^>(.+)$")
     re_accession  = re.compile("^>([^\s^\|]+)[\s\|]+")
@@ -267,23 +326,10 @@ class BasicProteinFasta(ProteinFasta):
     def parse_header(self, header=''):
         """ヘッダー行をパースして情報を取り出します。
         このクラスでは、識別のための文字列しか取り出しません。"""
-        if header =="":
-            header = self.header
-        matches = {}
-        matches['identifier'] = self.re_identifier.findall(header)
-        matches['accession']  = self.re_accession.findall(header)
-        matches['organism']   = self.re_organism.findall(header)
-        # 目的のものが見つからなかった場合に、デフォルトの値をセットする。
-        for key in ('identifier', 'accession', 'organism'):
-            if len(matches[key]) == 0:
-                matches[key] = [self.parser_default_values[key]]
-                if key == 'identifier':
-                    raise InvalidValueWarning(
-                            "No " + key + " found in the header line: " + header
-                           )
-        self.identifier = matches['identifier'][0]
-        self.accession  = matches['accession'][0]
-        self.organism   = matches['organism'][0]
+        # 遅延パースをせず、すべての値をこの時点で確定させる。
+        self.identifier = self.parse_field('identifier', header)
+        self.accession  = self.parse_field('accession', header)
+        self.organism   = self.parse_field('organism', header)
 
     def connect_db(self, query=''):
         """データベースに接続するためのメソッドです。
@@ -297,6 +343,7 @@ class SwissProt(BasicProteinFasta):
     SwissProtのFastaファイルを扱うクラス。とりあえずタンパク質の方に
     対応している。動的にタンパク質とDNAを切り替えられるようにした方が
     いいのかもしれない。どうせDNA使わないからあれなんだけど。"""
+    __slots__ = ()
 
     re_identifier = re.compile("^>sp\|[^\|]+\|(\S+) ")
     re_accession  = re.compile("^>sp\|([^\|]+)\|.*")
@@ -307,6 +354,7 @@ class TrEMBLE(BasicProteinFasta):
 
     ほとんどSwissProtと一緒だけど、こちらは機械的にアノテーション
     されたもの。まーフォーマットは最初の二文字が違うってだけなんだけど。"""
+    __slots__ = ()
 
     re_identifier = re.compile("^>tr\|[^\|]+\|(\S+) ")
     re_accession  = re.compile("^>tr\|([^\|]+)\|.*")
@@ -317,6 +365,7 @@ class GenBank_refseq(BasicProteinFasta):
     データベースの配列のためのクラス。
 
     他にもGenBank_gbやらGenBank_eucみたいなのがあるはず。"""
+    __slots__ = ()
 
     re_identifier = re.compile("^>gi\|\d+\|ref\|([^\|]+)\|? ")
     re_accession  = re.compile("^>gi\|(\d+)\|ref.*")
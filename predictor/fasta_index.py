@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""fasta_index  gives random access to records of a large FASTA file.
+
+build_index scans a FASTA file once and records the byte offset and length
+of every record, keyed by its identifier. The index is stored next to the
+FASTA file (<filename>.idx) and reused as long as the file is unchanged.
+IndexedFastaDataSet memory-maps the FASTA file and parses a record only
+when it is accessed.
+"""
+
+import copy
+import mmap
+import os
+import os.path
+import warnings
+
+from . import dataset
+from . import fasta
+
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 'tapp-fasta-index 1'
+
+
+def index_filename(filename):
+    """Return the name of the index file of filename."""
+    return filename + INDEX_SUFFIX
+
+
+def header_identifier(builder, header):
+    """Extract the identifier the builder's prototype would parse."""
+    prototype = builder.guess_database(header)
+    matches = prototype.re_identifier.findall(header)
+    if len(matches) == 0:
+        raise fasta.InvalidValueWarning(
+                "No identifier found in the header line: " + header)
+    return matches[0]
+
+
+def scan(filename, builder):
+    """Yield (identifier, offset, length) of every record in filename."""
+    with open(filename, 'rb') as f:
+        if f.read(2) == b'\x1f\x8b':
+            raise ValueError(filename + " is compressed and cannot be indexed.")
+        f.seek(0)
+        offset = 0
+        start = None
+        identifier = None
+        for line in f:
+            if line[:1] == b'>':
+                if start is not None:
+                    yield (identifier, start, offset - start)
+                start = offset
+                header = line.decode('utf-8', 'replace').strip()
+                identifier = header_identifier(builder, header)
+            offset += len(line)
+        if start is not None:
+            yield (identifier, start, offset - start)
+
+
+def build_index(filename, builder):
+    """Scan filename, write its index next to it and return the index.
+
+    The index is a dictionary of an identifier and (offset, length).
+    Only the first record of a duplicated identifier is indexed."""
+    index = {}
+    for identifier, offset, length in scan(filename, builder):
+        if identifier in index:
+            warnings.warn(fasta.InvalidValueWarning(
+                "duplicated identifier %s in %s" % (identifier, filename)))
+            continue
+        index[identifier] = (offset, length)
+    stat = os.stat(filename)
+    with open(index_filename(filename), 'w', encoding='utf-8') as f:
+        f.write("# %s\t%d\t%d\n" % (INDEX_VERSION, stat.st_size, stat.st_mtime_ns))
+        for identifier, (offset, length) in index.items():
+            f.write("%s\t%d\t%d\n" % (identifier, offset, length))
+    return index
+
+
+def load_index(filename, builder):
+    """Return the index of filename, building it if missing or stale."""
+    stat = os.stat(filename)
+    expected = "# %s\t%d\t%d" % (INDEX_VERSION, stat.st_size, stat.st_mtime_ns)
+    try:
+        with open(index_filename(filename), encoding='utf-8') as f:
+            if f.readline().rstrip("\n") != expected:
+                return build_index(filename, builder)
+            index = {}
+            for line in f:
+                identifier, offset, length = line.rstrip("\n").rsplit("\t", 2)
+                index[identifier] = (int(offset), int(length))
+            return index
+    except (IOError, OSError):
+        return build_index(filename, builder)
+
+
+class IndexedRecords(object):
+    """IndexedRecords  a mapping of identifiers to lazily parsed records.
+
+    Records assigned explicitly (e.g. by DataSet.merge) are kept in memory,
+    the others are parsed from the memory-mapped file on every access.
+    The map and the index are shared by the views of a file, but each view
+    holds only its own members (a subset of the identifiers)."""
+
+    def __init__(self, mapped, index, reader, members=None):
+        """Constructor.
+
+        @param members  is an iterable of the identifiers the view holds
+                        (all those of the index if None)."""
+        self.mapped = mapped
+        self.index = index
+        self.reader = reader
+        self.members = set(index if members is None else members)
+        self.records = {}
+
+    def __getitem__(self, key):
+        if key in self.records:
+            return self.records[key]
+        if key not in self.members:
+            raise KeyError(key)
+        offset, length = self.index[key]
+        text = self.mapped[offset:offset + length].decode('utf-8', 'replace')
+        record = next(self.reader.iter_string(text))
+        # the identifier is known, so the header needs no parsing
+        record.identifier = key
+        return record
+
+    def __setitem__(self, key, val):
+        self.records[key] = val
+        self.members.add(key)
+
+    def __delitem__(self, key):
+        # the shared index is left untouched
+        if key not in self.members:
+            raise KeyError(key)
+        self.members.discard(key)
+        self.records.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.members
+
+    def view(self, members, do_deepcopy=False):
+        """Return the records of members, sharing the map and the index.
+
+        Records kept in memory are copied into the new view's own dict
+        (and deep-copied themselves if do_deepcopy)."""
+        new = IndexedRecords(self.mapped, self.index, self.reader, members)
+        records = {key: self.records[key] for key in new.members
+                   if key in self.records}
+        new.records = copy.deepcopy(records) if do_deepcopy else records
+        return new
+
+    def __deepcopy__(self, memo):
+        # the file is read-only, so the map and the index can be shared
+        new = IndexedRecords(self.mapped, self.index, self.reader, self.members)
+        new.records = copy.deepcopy(self.records, memo)
+        return new
+
+
+class IndexedFastaDataSet(dataset.DataSet):
+    """IndexedFastaDataSet  a FastaDataSet backed by an indexed FASTA file.
+
+    Opening it reads only the index. Subsets made by copy() (and thus the
+    folds of cross validation) share the memory map instead of parsing."""
+
+    def __init__(self, filename, reader, name='', origin='', labels=None,
+                 identifiers=None):
+        """Constructor.
+
+        @param reader  is a FastaReader used to parse accessed records.
+        @param identifiers  restricts the dataset to these identifiers."""
+        index = load_index(filename, reader.builder)
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if identifiers is None:
+            identifiers = list(index)
+        self.container = IndexedRecords(mapped, index, reader, identifiers)
+        self._set_view(identifiers, name, origin, labels)
+
+    def _set_view(self, identifiers, name='', origin='', labels=None):
+        """Set identifiers, name and labels as FastaDataSet does."""
+        self.current_index = 0
+        self.data_type = fasta.Fasta
+        self.identifiers = list(identifiers)
+        self.seqnum = len(self.identifiers)
+        self.name = name
+        self.origin = origin or name
+        if labels != None and not type(labels) in (list, tuple, dict):
+            self.labels = {key: labels for key in self.identifiers}
+        elif isinstance(labels, dict):
+            self.labels = labels
+        else:
+            self.labels = {}
+            self.set_labels(0)
+
+    def copy(self, idlist, do_deepcopy=False):
+        """Return a dataset of idlist which shares the memory map."""
+        new = copy.copy(self)
+        new.container = self.container.view(idlist, do_deepcopy)
+        new._set_view(idlist, self.name, self.origin, self.copy_labels(idlist))
+        return new
@@ -3,10 +3,16 @@
 
 import predictor.hmm.hmm as hmm
 import predictor.hmm.hmm_mp as hmm_mp
-import predictor.hmm.util as hmmutil
 import predictor.dataset
+import predictor.fasta as fasta
+import hashlib
+import warnings
 import numpy as np
 import predictor.method as method
+import predictor.viterbi as viterbi
+import predictor.codec as codec
+import predictor.cache as cache
+import predictor.compiled as compiled
 
 class MyHmmPredictor(method.Method):
     """MyHmmPredictor  A wrapper of my implementation of HMM.
@@ -15,25 +21,64 @@ class MyHmmPredictor(method.Method):
     make the datasets into numerical form that suit my implementation."""
 
     def __init__(self, filename='', cpus=1,
-                 valid_chars="ACDEFGHIKLMNPQRSTVWY"):
-        '''Read an XML file of GHMM and convert it.'''
+                 valid_chars="ACDEFGHIKLMNPQRSTVWY", cache_size=0,
+                 checkpoint_length=viterbi.CHECKPOINT_LENGTH):
+        '''Read an XML file of GHMM and convert it.
+
+        @param cache_size  enables memoizing results of that many sequences.
+        @param checkpoint_length  is the length above which a sequence is
+                                  decoded in linear memory (see
+                                  viterbi.BatchViterbi.decode_checkpointed).'''
         self.method_name = 'hmm'
         self.model_file = filename
         self.method = None
+        self.engine = None
         self.valid_chars = valid_chars
-        self.valid_char_dic = {
-            self.valid_chars[i]: i for i in range(len(self.valid_chars))}
+        self.codec = codec.SequenceCodec(valid_chars)
         self.decoder = ""
+        self.state_codec = None
+        self.fingerprint = None
+        self.cache = cache.LRUCache(cache_size) if cache_size > 0 else None
+        self.checkpoint_length = checkpoint_length
         self.load(filename, cpus)
 
     def load(self, filename, cpus=1):
-        """Read an XML file of GHMM."""
-        (t, e, i) = hmmutil.load_ghmmxml(filename)
+        """Read an XML file of GHMM.
+
+        Its compiled form (see predictor.compiled) is used instead when
+        it has been compiled from the same content, and written otherwise."""
+        model = compiled.load_model(filename)
+        self.engine = viterbi.BatchViterbi.from_log(
+                model['log_t'], model['log_e'], model['log_i'],
+                checkpoint_length=self.checkpoint_length)
+        self.update_fingerprint()
+        # writable copies of the (memory-mapped) arrays, as training updates them
+        (t, e, i) = (np.array(model['t']), np.array(model['e']),
+                     np.array(model['i']))
         if cpus == 1:
             self.method = hmm.HMM(t, e, i)
         elif cpus > 1:
             self.method = hmm_mp.MultiProcessHMM(t, e, i, worker_num=cpus)
 
+    def update_fingerprint(self):
+        """Recompute the fingerprint of the model and the decoder.
+
+        Memoized results of another fingerprint are discarded. The
+        fingerprint is None (and memoization is off) after training,
+        because the parameters are no longer those loaded from the file."""
+        if self.engine is None:
+            fingerprint = None
+        else:
+            digest = hashlib.sha256()
+            for array in (self.engine.log_t, self.engine.log_e,
+                          self.engine.log_i):
+                digest.update(np.ascontiguousarray(array).tobytes())
+            digest.update(self.decoder.encode('utf-8'))
+            fingerprint = digest.hexdigest()
+        if fingerprint != self.fingerprint and self.cache is not None:
+            self.cache.clear()
+        self.fingerprint = fingerprint
+
     def initialize(self, cpus=1):
         """Reload hmm files"""
         if self.model_file:
@@ -42,13 +87,94 @@ class MyHmmPredictor(method.Method):
     def predict(self, dataset, reverse=False, **args):
         """Predict (or Decode) a sequence by Viterbi algorithm."""
         dataset_tmp = self.convert_dataset(dataset, reverse)
-        result_tmp = {i: self.method.viterbi(d, return_omega=True)      # i: identifier
-                      for i, d in list(dataset_tmp.items())} # d: (converted) data
+        return self.predict_converted(dataset_tmp, reverse)
+
+    def predict_converted(self, dataset_tmp, reverse=False):
+        """Decode sequences already converted by convert_dataset.
+
+        @param dataset_tmp  is a dictionary of identifiers and encoded sequences.
+        @param reverse  tells whether the sequences have been reversed."""
+        if self.engine is not None and self.cache is not None \
+                and self.fingerprint is not None:
+            result_tmp = self.decode_memoized(dataset_tmp)
+        elif self.engine is not None:
+            decoded = self.engine.decode(list(dataset_tmp.values()),
+                                         return_omega=True)
+            result_tmp = dict(zip(dataset_tmp.keys(), decoded))
+        else:
+            # parameters have been changed by training, so ask the model itself
+            result_tmp = {i: self.method.viterbi(d, return_omega=True)      # i: identifier
+                          for i, d in list(dataset_tmp.items())} # d: (converted) data
         return self.convert_result(result_tmp, reverse=reverse)
 
+    def decode_memoized(self, dataset_tmp):
+        """Decode sequences, looking up and filling the memo cache.
+
+        Identical sequences are decoded only once, even within a call."""
+        keys = {}
+        found = {}
+        pending = {}
+        for i, d in dataset_tmp.items():
+            key = (self.fingerprint,
+                   np.asarray(d, dtype=np.uint8).tobytes())
+            keys[i] = key
+            if key in found or key in pending:
+                continue
+            hit = self.cache.get(key)
+            if hit is None:
+                pending[key] = d
+            else:
+                found[key] = hit
+        decoded = self.engine.decode(list(pending.values()), return_omega=True)
+        for key, result in zip(pending.keys(), decoded):
+            self.cache.put(key, result)
+            found[key] = result
+        return {i: found[keys[i]] for i in dataset_tmp}
+
+    def score(self, dataset, reverse=False):
+        """Return the likelihoods of the best paths (by Viterbi algorithm).
+
+        It is the likelihood of predict() without decoding the paths.
+
+        @return  a dictionary of identifiers and likelihoods."""
+        return self.score_converted(self.convert_dataset(dataset, reverse))
+
+    def score_converted(self, dataset_tmp):
+        """Score sequences already converted by convert_dataset."""
+        if self.engine is None:
+            # parameters have been changed by training, so ask the model itself
+            return {i: self.method.viterbi(d)[1]
+                    for i, d in list(dataset_tmp.items())}
+        if self.cache is None or self.fingerprint is None:
+            return dict(zip(dataset_tmp.keys(),
+                            self.engine.score(list(dataset_tmp.values()))))
+        likelihoods = {}
+        pending = {}
+        for i, d in dataset_tmp.items():
+            key = (self.fingerprint, np.asarray(d, dtype=np.uint8).tobytes())
+            # a decoded result has the likelihood as well
+            hit = self.cache.get(key)
+            if hit is None:
+                hit = self.cache.get(key + ('likelihood',))
+            else:
+                hit = hit[1]
+            if hit is None:
+                pending.setdefault(key, []).append(i)
+            else:
+                likelihoods[i] = hit
+        scored = self.engine.score([dataset_tmp[ids[0]] for ids in pending.values()])
+        for (key, ids), likelihood in zip(pending.items(), scored):
+            self.cache.put(key + ('likelihood',), likelihood)
+            for i in ids:
+                likelihoods[i] = likelihood
+        return {i: likelihoods[i] for i in dataset_tmp}
+
     def train(self, dataset, reverse=False, if_debug=False, **args):
         """Train sequences using Baum-Welch algorithm."""
         dataset_tmp = self.convert_dataset(dataset, reverse)
+        # the batched decoder holds the parameters as loaded from the file
+        self.engine = None
+        self.update_fingerprint()
         if if_debug:
             return self.method.baum_welch(list(dataset_tmp.values()), do_debug=True, **args)
         else:
@@ -57,37 +183,47 @@ class MyHmmPredictor(method.Method):
     def convert_dataset(self, dataset, reverse=False, missing='ignore'):
         """Convert DataSet objects into numerical form.
 
+        Each sequence becomes a uint8 array (a reversed view if reverse).
+
         @param dataset  is a DataSet object.
         @param reverse  is a boolean"""
         converted = {}
+        if hasattr(dataset, 'sequence_columns'):
+            # encode all the sequences at once, and slice them as views
+            identifiers, residues, offsets = dataset.sequence_columns()
+            encoded, offsets = self.codec.encode_many(residues, offsets,
+                                                      missing, identifiers)
+            for n, identifier in enumerate(identifiers):
+                converted_tmp = encoded[offsets[n]:offsets[n + 1]]
+                if reverse:
+                    converted_tmp = self.codec.reverse(converted_tmp)
+                converted[identifier] = converted_tmp
+            return converted
         for seq in dataset:
-            converted_tmp = []
-            for c in seq.sequence:
-                try:
-                    converted_tmp.append(self.valid_char_dic[c])
-                except KeyError:
-                    if missing == 'ignore':
-                        print("invalid character %s found." % c)
-                    elif missing == 'error':
-                        raise ValueError("Invalid character: " + c)
+            converted_tmp = self.codec.encode(seq.sequence, missing,
+                                              seq.identifier)
             if reverse:
-                converted_tmp = converted_tmp[::-1]
+                converted_tmp = self.codec.reverse(converted_tmp)
             converted[seq.identifier] = converted_tmp
         return converted
 
     def convert_result(self, results, reverse=False):
-        """Convert numerical representation into more readable form."""
+        """Convert numerical representation into more readable form.
+
+        Paths are left empty (with a warning) if no decoder is set."""
         converted = {}
+        if self.state_codec is None and len(results) > 0:
+            warnings.warn(fasta.InvalidValueWarning(
+                "No decoder is set, so the paths are left empty "
+                "(see set_decoder)."))
         for i, result in list(results.items()):
-            converted_tmp = ""
-            for n in result[0]:  # result[1] is a likelihood
-                try:
-                    converted_tmp += self.decoder[int(n)]
-                except IndexError:
-                    print("%d is out of range (only %d states registered)." \
-                            % (n, len(self.decoder)))
-            if reverse:
-                converted_tmp = converted_tmp[::-1]
+            # result[1] is a likelihood
+            if self.state_codec is None:
+                converted_tmp = ""
+            elif reverse:
+                converted_tmp = self.state_codec.decode(result[0][::-1])
+            else:
+                converted_tmp = self.state_codec.decode(result[0])
             converted[i] = {'path': converted_tmp,
                             'pathnum': result[0],
                             'likelihood': result[1]}
@@ -99,6 +235,7 @@ class MyHmmPredictor(method.Method):
         """Reset valid characters, which are used in convert_dataset method."""
         if len(chars) > 0:
             self.valid_chars = chars
+            self.codec = codec.SequenceCodec(chars)
         else:
             raise ValueError("chars must contain at least one character.")
 
@@ -111,6 +248,9 @@ class MyHmmPredictor(method.Method):
     def set_decoder(self, charlist):
         """Set decoder which is used in converting numerical states."""
         self.decoder = charlist
+        # a model may have more states than a uint8 table can encode
+        self.state_codec = codec.SequenceCodec(charlist, decode_only=True)
+        self.update_fingerprint()
 
     def cross_valid(self, dataset, fold=5, is_random=True,
                     pseudocounts=[0, 0, 0], cpus=1, **args):
@@ -127,6 +267,126 @@ class MyHmmPredictor(method.Method):
         return result_of_cv
 
 
+class MultiHmmPredictor(object):
+    """MultiHmmPredictor  scores a dataset against several MyHmmPredictor models.
+
+    The dataset is converted only once for each set of valid characters
+    (and reversed at most once), and every registered model decodes the
+    shared numerical form in one call, so that it can be scheduled as a
+    single job."""
+
+    def __init__(self, models=None):
+        """Constructor.
+
+        @param models  is a dictionary of a name and (MyHmmPredictor, reverse)."""
+        self.models = {}
+        # models whose results have only the likelihood (see register)
+        self.likelihood_only = set()
+        if models:
+            for name, (model, reverse) in models.items():
+                self.register(name, model, reverse)
+
+    def register(self, name, model, reverse=False, likelihood_only=False):
+        """Register a model with its name and direction.
+
+        @param likelihood_only  makes the results of the model a dictionary
+                                of only 'likelihood' for each sequence,
+                                which is scored without decoding the path."""
+        if name in self.models:
+            raise ValueError(name + " already registered.")
+        self.models[name] = (model, reverse)
+        if likelihood_only:
+            self.likelihood_only.add(name)
+
+    def predict(self, dataset, names=None):
+        """Predict a dataset with the registered models.
+
+        @param names  restricts the models to use (all models if None).
+        @return  a dictionary of a model name and its result of predict()."""
+        if names is None:
+            names = list(self.models.keys())
+        results = {}
+        for valid_chars in set(self.models[n][0].valid_chars for n in names):
+            group = [n for n in names
+                     if self.models[n][0].valid_chars == valid_chars]
+            forward = self.models[group[0]][0].convert_dataset(dataset)
+            results.update(self.predict_converted(forward, group))
+        return results
+
+    def predict_many(self, datasets, names=None):
+        """Predict several datasets as one job.
+
+        Identifiers only have to be unique within each dataset.
+
+        @return  a list of the results of predict(), one for each dataset."""
+        if names is None:
+            names = list(self.models.keys())
+        results = {}
+        for valid_chars in set(self.models[n][0].valid_chars for n in names):
+            group = [n for n in names
+                     if self.models[n][0].valid_chars == valid_chars]
+            model = self.models[group[0]][0]
+            forward = {}
+            for n, dataset in enumerate(datasets):
+                for identifier, encoded in model.convert_dataset(dataset).items():
+                    forward[(n, identifier)] = encoded
+            results.update(self.predict_converted(forward, group))
+        return split_results(results, len(datasets))
+
+    def predict_converted(self, forward, names=None):
+        """Predict sequences already converted in the forward direction.
+
+        All the models in names have to share the same valid characters.
+        The reversed form is derived from the forward one, only once."""
+        if names is None:
+            names = list(self.models.keys())
+        backward = None
+        results = {}
+        for name in names:
+            model, reverse = self.models[name]
+            if reverse:
+                if backward is None:
+                    backward = {i: d[::-1] for i, d in forward.items()}
+                converted = backward
+            else:
+                converted = forward
+            if name in self.likelihood_only:
+                results[name] = {i: {'likelihood': likelihood} for i, likelihood
+                                 in model.score_converted(converted).items()}
+            else:
+                results[name] = model.predict_converted(converted, reverse)
+        return results
+
+
+def split_results(results, count):
+    """Split results keyed by (n, identifier) into a list of count results."""
+    split = [{name: {} for name in results} for n in range(count)]
+    for name, result in results.items():
+        for (n, identifier), value in result.items():
+            split[n][name][identifier] = value
+    return split
+
+
+def load_predictors(specs, cpus=1):
+    """Create a MultiHmmPredictor from model specifications.
+
+    @param specs  is a dictionary of a model name and a dictionary with keys
+                  'filename', 'decoder' and optionally 'reverse',
+                  'likelihood_only' (see MultiHmmPredictor.register),
+                  'cache_size' and 'checkpoint_length'."""
+    predictors = MultiHmmPredictor()
+    for name, spec in specs.items():
+        model = MyHmmPredictor(filename=spec['filename'], cpus=cpus,
+                               cache_size=spec.get('cache_size', 0),
+                               checkpoint_length=spec.get(
+                                   'checkpoint_length',
+                                   viterbi.CHECKPOINT_LENGTH))
+        model.set_decoder(spec['decoder'])
+        predictors.register(name, model, spec.get('reverse', False),
+                            spec.get('likelihood_only', False))
+    return predictors
+
+
 class HMMResultSet(predictor.dataset.DataSet):
     """HMMResultSet  is a class that concatenates several results of viterbi.
 
@@ -151,10 +411,9 @@ class HMMResultSet(predictor.dataset.DataSet):
         self.models.append(model)
         for name, result in list(dataset.items()):
             # result is a dictionary which has two keys, likelihood and path.
-            if name not in self.identifiers:
+            if name not in self.container:
                 self.identifiers.append(name)
                 self.seqnum += 1
-            if name not in self.container:
                 self.container[name] = {model: result, 'origin': test}
                 if test not in self.origins:
                     self.origins.append(test)
@@ -271,7 +530,7 @@ class HMMResultSet(predictor.dataset.DataSet):
         if isinstance(what, str):  ## Assume it indicates an origin.
             return [how(name) for name in self.iter_names_by_origin(what)]
         elif isinstance(what, (tuple, list)):
-            if all([elem in self.identifiers for elem in what]):
+            if all([elem in self.container for elem in what]):
                 ### Assume 'what' is a list of the identifiers
                 return [how(name) for name in what]
             elif all([elem in self.origins for elem in what]):
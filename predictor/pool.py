@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""pool  runs predictions of MyHmmPredictor models on a process pool.
+
+Every worker process loads the models once when it starts, so that the
+pure-Python parts of the prediction are not serialized by the GIL.
+Queries are sent to the workers as a compact buffer of encoded residues
+and offsets instead of pickled Fasta objects.
+"""
+
+import concurrent.futures
+
+import numpy as np
+
+import predictor.codec as codec
+import predictor.method_hmm as method_hmm
+
+# Models loaded in a worker process (set by _initialize_worker).
+_worker_predictors = None
+
+
+def _initialize_worker(specs):
+    """Load the models once per worker process."""
+    global _worker_predictors
+    _worker_predictors = method_hmm.load_predictors(specs)
+
+
+def _predict_packed(identifiers, residues, offsets, names=None):
+    """Unpack the buffers and predict them with the preloaded models."""
+    residues = np.frombuffer(residues, dtype=np.uint8)
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+    forward = {identifier: residues[offsets[n]:offsets[n + 1]]
+               for n, identifier in enumerate(identifiers)}
+    return _worker_predictors.predict_converted(forward, names)
+
+
+def _predict_packed_many(identifiers, residues, offsets, count, names=None):
+    """Predict buffers of several datasets and split the result by dataset."""
+    return method_hmm.split_results(
+            _predict_packed(identifiers, residues, offsets, names), count)
+
+
+def pack_dataset(dataset, valid_chars="ACDEFGHIKLMNPQRSTVWY"):
+    """Encode a dataset into (identifiers, residues, offsets).
+
+    residues is the concatenation of all the encoded sequences as bytes,
+    and offsets (int64 bytes) marks where each sequence begins and ends.
+    Invalid characters are skipped as MyHmmPredictor.convert_dataset does."""
+    sequence_codec = codec.SequenceCodec(valid_chars)
+    if hasattr(dataset, 'sequence_columns'):
+        identifiers, residues, offsets = dataset.sequence_columns()
+        encoded, offsets = sequence_codec.encode_many(residues, offsets,
+                                                      names=identifiers)
+        return (identifiers, encoded.tobytes(), offsets.tobytes())
+    identifiers = []
+    chunks = []
+    offsets = [0]
+    for seq in dataset:
+        encoded = sequence_codec.encode(seq.sequence, name=seq.identifier)
+        identifiers.append(seq.identifier)
+        chunks.append(encoded)
+        offsets.append(offsets[-1] + len(encoded))
+    return (identifiers, np.concatenate(chunks).tobytes() if chunks else b'',
+            np.array(offsets, dtype=np.int64).tobytes())
+
+
+class ProcessPoolHmmPredictor(object):
+    """ProcessPoolHmmPredictor  predicts datasets on worker processes.
+
+    It offers the same predict() as MultiHmmPredictor, and submit() which
+    returns a concurrent.futures.Future that can be yielded in coroutines."""
+
+    def __init__(self, specs, workers=None,
+                 valid_chars="ACDEFGHIKLMNPQRSTVWY"):
+        """Constructor.
+
+        @param specs  is a dictionary of model specifications
+                      (see method_hmm.load_predictors).
+        @param workers  is the number of processes (the number of CPUs if None).
+        @param valid_chars  has to be the same as those of the models."""
+        self.specs = specs
+        self.valid_chars = valid_chars
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+                workers,
+                initializer=_initialize_worker,
+                initargs=(specs,))
+
+    def submit(self, dataset, names=None):
+        """Start predicting a dataset and return the future of the result."""
+        identifiers, residues, offsets = pack_dataset(dataset, self.valid_chars)
+        return self.executor.submit(_predict_packed,
+                                    identifiers, residues, offsets, names)
+
+    def submit_many(self, datasets, names=None):
+        """Start predicting several datasets as one job.
+
+        The result of the future is a list of results, one for each dataset."""
+        identifiers = []
+        chunks = []
+        offsets = [np.zeros(1, dtype=np.int64)]
+        total = 0
+        for n, dataset in enumerate(datasets):
+            ids, residues, packed = pack_dataset(dataset, self.valid_chars)
+            identifiers.extend((n, identifier) for identifier in ids)
+            chunks.append(residues)
+            offsets.append(np.frombuffer(packed, dtype=np.int64)[1:] + total)
+            total += len(residues)
+        return self.executor.submit(_predict_packed_many, identifiers,
+                                    b''.join(chunks),
+                                    np.concatenate(offsets).tobytes(),
+                                    len(datasets), names)
+
+    def predict(self, dataset, names=None):
+        """Predict a dataset and wait for the result."""
+        return self.submit(dataset, names).result()
+
+    def shutdown(self, wait=True):
+        """Stop the worker processes."""
+        self.executor.shutdown(wait)
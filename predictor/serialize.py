@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""serialize  converts predicted results into compact, JSON-ready values.
+
+A decoded path mostly consists of long runs of the same label (and of
+the same state), so paths are stored as run-length segments. The scores
+of each position (omega) are stored as fixed-precision integers, each
+the difference from the previous one, packed into a base64 string of
+16-bit (or, if they do not fit, 32-bit) little-endian integers.
+The verbose form (a path string and lists of every state and score) can
+be restored by expand_result. pack and unpack compress a JSON document
+for storage.
+"""
+
+import base64
+import zlib
+
+import numpy as np
+
+# number of decimal places kept for omega
+OMEGA_PRECISION = 2
+
+
+def run_length(values):
+    """Return (values, lengths) of the runs of equal values in a 1-D array."""
+    values = np.asarray(values)
+    if len(values) == 0:
+        return (values, np.zeros(0, dtype=np.int64))
+    starts = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(values)))
+    return (values[starts], lengths)
+
+
+def string_runs(s):
+    """Return the runs of a string as a list of [character, length]."""
+    symbols, lengths = run_length(np.frombuffer(s.encode('ascii'), dtype=np.uint8))
+    return [[chr(symbol), length]
+            for symbol, length in zip(symbols.tolist(), lengths.tolist())]
+
+
+def expand_string_runs(runs):
+    """Restore a string from a list of [character, length]."""
+    return ''.join(symbol * length for symbol, length in runs)
+
+
+def state_runs(states):
+    """Return the runs of an array of states as a list of [state, length]."""
+    symbols, lengths = run_length(states)
+    return [list(run) for run in zip(symbols.tolist(), lengths.tolist())]
+
+
+def expand_state_runs(runs):
+    """Restore a list of states from a list of [state, length]."""
+    expanded = []
+    for state, length in runs:
+        expanded.extend([state] * length)
+    return expanded
+
+
+def fixed_deltas(values, precision=OMEGA_PRECISION):
+    """Encode floats as differences of integers scaled by 10 ** precision.
+
+    @return  a dictionary of 'precision', 'dtype' (a NumPy type string)
+             and 'data' (base64), or None if some values are not finite."""
+    values = np.asarray(values, dtype=np.float64)
+    if not np.isfinite(values).all():
+        return None
+    deltas = np.diff(np.round(values * 10 ** precision).astype(np.int64),
+                     prepend=0)
+    for dtype in ('<i2', '<i4'):
+        limits = np.iinfo(dtype)
+        if len(deltas) == 0 or (deltas.min() >= limits.min
+                                and deltas.max() <= limits.max):
+            data = base64.b64encode(deltas.astype(dtype).tobytes())
+            return {'precision': precision, 'dtype': dtype,
+                    'data': data.decode('ascii')}
+    return None
+
+
+def restore_fixed(fixed):
+    """Decode the values encoded by fixed_deltas into a list of floats."""
+    deltas = np.frombuffer(base64.b64decode(fixed['data']),
+                           dtype=fixed['dtype'])
+    return (np.cumsum(deltas, dtype=np.int64)
+            / 10 ** fixed['precision']).tolist()
+
+
+def first_run(runs, symbol):
+    """Return (start, end) of the first run of symbol, or (-1, -1)."""
+    position = 0
+    for s, length in runs:
+        if s == symbol:
+            return (position, position + length)
+        position += length
+    return (-1, -1)
+
+
+def compact_result(result, precision=OMEGA_PRECISION):
+    """Replace path, pathnum and omega of a verbose result by
+    path_runs, state_runs and omega_fixed.
+
+    A compact result is returned as it is. omega is kept as a list of
+    floats when it cannot be encoded (e.g. contains -inf)."""
+    if 'path' not in result:
+        return result
+    compact = dict(result)
+    compact['path_runs'] = string_runs(compact.pop('path'))
+    compact['state_runs'] = state_runs(compact.pop('pathnum'))
+    fixed = fixed_deltas(compact['omega'], precision)
+    if fixed is not None:
+        del compact['omega']
+        compact['omega_fixed'] = fixed
+    return compact
+
+
+def expand_result(result):
+    """Restore the verbose form of a compact result (see compact_result).
+
+    A verbose result is returned as it is."""
+    if 'path_runs' not in result:
+        return result
+    expanded = dict(result)
+    expanded['path'] = expand_string_runs(expanded.pop('path_runs'))
+    expanded['pathnum'] = expand_state_runs(expanded.pop('state_runs'))
+    if 'omega_fixed' in expanded:
+        expanded['omega'] = restore_fixed(expanded.pop('omega_fixed'))
+    return expanded
+
+
+def pack(document):
+    """Compress a JSON document (str) into bytes for storage."""
+    return zlib.compress(document.encode('utf-8'), 6)
+
+
+def unpack(packed):
+    """Restore the JSON document (str) compressed by pack."""
+    return zlib.decompress(packed).decode('utf-8')
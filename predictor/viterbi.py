@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""viterbi  is a batched Viterbi decoder written with NumPy.
+
+The models loaded by MyHmmPredictor are decoded one sequence at a time by
+predictor.hmm, which spends most of its time in the Python interpreter.
+BatchViterbi groups the encoded sequences into length buckets and runs the
+max-product recursion over all states and all sequences in a bucket as one
+array operation, returning the same (path, likelihood, omega) tuples.
+"""
+
+import numpy as np
+
+# the sparse recursion is used when no state has more predecessors than
+# this fraction of the states (see BatchViterbi.analyze)
+SPARSE_RATIO = 0.5
+# sequences longer than this are decoded with checkpoints (see
+# BatchViterbi.decode_checkpointed) instead of full back pointer tables
+CHECKPOINT_LENGTH = 10000
+
+
+def to_log(array):
+    """Return log(array), mapping zero probabilities to -inf silently."""
+    with np.errstate(divide='ignore'):
+        return np.log(np.asarray(array, dtype=np.float64))
+
+
+class BatchViterbi(object):
+    """BatchViterbi  decodes many sequences at once with the Viterbi algorithm.
+
+    The model is given as the usual (transition, emission, initial)
+    probability arrays, which are kept in log space."""
+
+    def __init__(self, t, e, i, max_cells=2 ** 22, sparse=None,
+                 checkpoint_length=CHECKPOINT_LENGTH):
+        """Constructor.
+
+        @param t  is a (N, N) transition matrix (from, to).
+        @param e  is a (N, M) emission matrix.
+        @param i  is a (N, ) initial probability vector.
+        @param max_cells  bounds the size of a bucket, counted as
+                          sequences * positions * states.
+        @param sparse  forces (True) or disables (False) the recursion over
+                       predecessor lists; None decides it by the topology.
+        @param checkpoint_length  is the length above which a sequence is
+                                  decoded with checkpoints."""
+        self.setup(to_log(t), to_log(e), to_log(i), max_cells, sparse,
+                   checkpoint_length)
+
+    @classmethod
+    def from_log(cls, log_t, log_e, log_i, max_cells=2 ** 22, sparse=None,
+                 checkpoint_length=CHECKPOINT_LENGTH):
+        """Create a decoder of a model given in log space.
+
+        The arrays are used as they are (e.g. memory-mapped ones of
+        predictor.compiled), so they are not copied."""
+        decoder = cls.__new__(cls)
+        decoder.setup(log_t, log_e, log_i, max_cells, sparse, checkpoint_length)
+        return decoder
+
+    def setup(self, log_t, log_e, log_i, max_cells, sparse=None,
+              checkpoint_length=CHECKPOINT_LENGTH):
+        """Keep the log-space model and derive the arrays used in decoding."""
+        self.log_t = log_t
+        self.log_e = log_e
+        self.log_i = log_i
+        self.state_num = self.log_i.shape[0]
+        # emissions indexed by symbol first, to gather rows per position
+        self.log_e_by_symbol = np.ascontiguousarray(self.log_e.T)
+        self.max_cells = max_cells
+        self.checkpoint_length = checkpoint_length
+        # back pointers are the largest array, so keep them narrow
+        self.pointer_type = np.uint8 if self.state_num <= 256 else np.int32
+        self.analyze(sparse)
+
+    def analyze(self, sparse=None):
+        """Build the predecessor lists of the states from the transitions.
+
+        The lists are kept in CSR form (predecessor_ptr, predecessors), and
+        as a (N, K) table padded to the largest in-degree K (with state 0
+        and -inf), in which the recursion looks up candidates.
+        The table is None when the dense recursion is used."""
+        allowed = np.isfinite(self.log_t)
+        # sorted by state, so that ties are broken as in the dense argmax
+        targets, sources = np.nonzero(allowed.T)
+        self.predecessors = sources
+        self.predecessor_ptr = np.concatenate(
+                ([0], np.cumsum(allowed.sum(axis=0))))
+        in_degree = max(int(np.diff(self.predecessor_ptr).max()), 1)
+        if sparse is None:
+            sparse = in_degree <= self.state_num * SPARSE_RATIO
+        if not sparse:
+            self.predecessor_table = None
+            self.predecessor_log_t = None
+            return
+        rank = np.arange(len(sources)) - self.predecessor_ptr[targets]
+        self.predecessor_table = np.zeros((self.state_num, in_degree),
+                                          dtype=np.intp)
+        self.predecessor_table[targets, rank] = sources
+        self.predecessor_log_t = np.full((self.state_num, in_degree), -np.inf)
+        self.predecessor_log_t[targets, rank] = self.log_t[sources, targets]
+
+    def step(self, scores, with_pointers=True):
+        """Extend the best paths ending in each state by one transition.
+
+        @param scores  is a (n, N) array of the scores of the last position.
+        @param with_pointers  can be False when only the scores are needed.
+        @return  (pointers, best); the best predecessor of each state (None
+                 without with_pointers) and its score (before the emission)."""
+        if self.predecessor_table is None:
+            candidates = scores[:, :, np.newaxis] + self.log_t
+            if not with_pointers:
+                return (None, candidates.max(axis=1))
+            pointers = candidates.argmax(axis=1)
+            best = np.take_along_axis(candidates, pointers[:, np.newaxis, :],
+                                      axis=1)[:, 0, :]
+            return (pointers, best)
+        candidates = scores[:, self.predecessor_table] + self.predecessor_log_t
+        if not with_pointers:
+            return (None, candidates.max(axis=2))
+        chosen = candidates.argmax(axis=2)
+        best = np.take_along_axis(candidates, chosen[:, :, np.newaxis],
+                                  axis=2)[:, :, 0]
+        pointers = self.predecessor_table[np.arange(self.state_num), chosen]
+        # the dense argmax points to state 0 when no predecessor is possible
+        pointers[best == -np.inf] = 0
+        return (pointers, best)
+
+    def buckets(self, lengths):
+        """Split indices of non-empty sequences into buckets of similar length.
+
+        Sequences are sorted by descending length, so that the sequences
+        still running at position t always form a prefix of a bucket."""
+        order = np.argsort(-np.asarray(lengths, dtype=np.int64), kind='stable')
+        bucket = []
+        for index in order:
+            if lengths[index] == 0:
+                break
+            # the first (longest) sequence determines the size of the bucket
+            width = lengths[bucket[0]] if bucket else lengths[index]
+            if bucket and (len(bucket) + 1) * width * self.state_num > self.max_cells:
+                yield bucket
+                bucket = []
+            bucket.append(index)
+        if bucket:
+            yield bucket
+
+    def decode(self, sequences, return_omega=True):
+        """Decode sequences and return a list of (path, likelihood[, omega]).
+
+        @param sequences  is a list of encoded sequences (lists or arrays of
+                          symbol indices).
+        @param return_omega  also returns the score of the decoded state at
+                             each position when True."""
+        sequences = [np.asarray(s, dtype=np.intp) for s in sequences]
+        lengths = [len(s) for s in sequences]
+        results = [None] * len(sequences)
+        for n, length in enumerate(lengths):
+            if length == 0:
+                results[n] = self.empty_result(return_omega)
+            elif length > self.checkpoint_length:
+                results[n] = self.decode_checkpointed(sequences[n],
+                                                      return_omega)
+                # so that buckets() leaves it out
+                lengths[n] = 0
+        for bucket in self.buckets(lengths):
+            decoded = self.decode_bucket([sequences[b] for b in bucket],
+                                         return_omega)
+            for b, result in zip(bucket, decoded):
+                results[b] = result
+        return results
+
+    def decode_bucket(self, sequences, return_omega=True):
+        """Run the recursion over sequences sorted by descending length."""
+        lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+        size, width = len(sequences), int(lengths[0])
+        observed = np.zeros((size, width), dtype=np.intp)
+        for n, s in enumerate(sequences):
+            observed[n, :len(s)] = s
+        # number of sequences that still have a symbol at each position
+        active = np.searchsorted(-lengths, -np.arange(width), side='left')
+
+        pointers = np.zeros((size, width, self.state_num), dtype=self.pointer_type)
+        history = np.empty((size, width, self.state_num)) if return_omega else None
+        scores = self.log_i + self.log_e_by_symbol[observed[:, 0]]
+        if return_omega:
+            history[:, 0] = scores
+        finals = np.empty((size, self.state_num))
+        for pos in range(1, width):
+            n = active[pos]
+            # sequences which ended at pos-1 keep their final scores
+            finished = active[pos - 1]
+            if n < finished:
+                finals[n:finished] = scores[n:finished]
+            pointers[:n, pos], best = self.step(scores[:n])
+            scores = best + self.log_e_by_symbol[observed[:n, pos]]
+            if return_omega:
+                history[:n, pos] = scores
+        n = active[width - 1]
+        finals[:n] = scores[:n]
+        paths = self.traceback(pointers, finals, active)
+        results = []
+        for n in range(size):
+            path = paths[n, :lengths[n]]
+            likelihood = finals[n, path[-1]]
+            if return_omega:
+                omega = history[n, np.arange(lengths[n]), path]
+                results.append((path, likelihood, omega))
+            else:
+                results.append((path, likelihood))
+        return results
+
+    def decode_checkpointed(self, sequence, return_omega=True):
+        """Decode a long sequence keeping only O(sqrt(L) * N) scores.
+
+        The forward pass keeps the scores of every interval-th position
+        (checkpoints). The traceback then recomputes one segment between
+        checkpoints at a time, from the last one, with its back pointers
+        and scores. It costs about twice the recursion of decode_bucket,
+        and gives the same (path, likelihood[, omega])."""
+        length = len(sequence)
+        interval = max(int(np.sqrt(length)), 1)
+        scores = (self.log_i + self.log_e_by_symbol[sequence[0]])[np.newaxis]
+        checkpoints = [scores]
+        for pos in range(1, length):
+            scores = (self.step(scores, with_pointers=False)[1]
+                      + self.log_e_by_symbol[sequence[pos]])
+            if pos % interval == 0:
+                checkpoints.append(scores)
+        state = int(scores[0].argmax())
+        likelihood = scores[0, state]
+
+        path = np.zeros(length, dtype=np.int64)
+        omega = np.empty(length) if return_omega else None
+        for k in range(len(checkpoints) - 1, -1, -1):
+            start = k * interval
+            end = min(start + interval, length)
+            # rows[j] and pointers[j] belong to position start + j; the
+            # segment is extended to the first position of the next one
+            rows = [checkpoints[k]]
+            pointers = [None]
+            for pos in range(start + 1, min(end + 1, length)):
+                pointer, best = self.step(rows[-1])
+                rows.append(best + self.log_e_by_symbol[sequence[pos]])
+                pointers.append(pointer)
+            if end < length:
+                # state is the one at end, found in the next segment
+                state = pointers[end - start][0, state]
+            for pos in range(end - 1, start - 1, -1):
+                path[pos] = state
+                if return_omega:
+                    omega[pos] = rows[pos - start][0, state]
+                if pos > start:
+                    state = pointers[pos - start][0, state]
+        if return_omega:
+            return (path, likelihood, omega)
+        return (path, likelihood)
+
+    def score(self, sequences):
+        """Return the likelihoods of the best paths of sequences.
+
+        They are the same as those of decode, but only the scores of the
+        current position are kept: no back pointers, paths or omega.
+
+        @param sequences  is a list of encoded sequences.
+        @return  a list of likelihoods (numpy.float64)."""
+        sequences = [np.asarray(s, dtype=np.intp) for s in sequences]
+        lengths = [len(s) for s in sequences]
+        likelihoods = [np.float64(-np.inf)] * len(sequences)
+        for bucket in self.buckets(lengths):
+            scored = self.score_bucket([sequences[b] for b in bucket])
+            for b, likelihood in zip(bucket, scored):
+                likelihoods[b] = likelihood
+        return likelihoods
+
+    def score_bucket(self, sequences):
+        """Run the recursion of decode_bucket without keeping its history."""
+        lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+        size, width = len(sequences), int(lengths[0])
+        observed = np.zeros((size, width), dtype=np.intp)
+        for n, s in enumerate(sequences):
+            observed[n, :len(s)] = s
+        active = np.searchsorted(-lengths, -np.arange(width), side='left')
+
+        scores = self.log_i + self.log_e_by_symbol[observed[:, 0]]
+        finals = np.empty(size)
+        for pos in range(1, width):
+            n = active[pos]
+            finished = active[pos - 1]
+            if n < finished:
+                finals[n:finished] = scores[n:finished].max(axis=1)
+            best = self.step(scores[:n], with_pointers=False)[1]
+            scores = best + self.log_e_by_symbol[observed[:n, pos]]
+        n = active[width - 1]
+        finals[:n] = scores[:n].max(axis=1)
+        return list(finals)
+
+    def traceback(self, pointers, finals, active):
+        """Follow back pointers of a whole bucket from the best final states."""
+        size, width = pointers.shape[:2]
+        paths = np.zeros((size, width), dtype=np.int64)
+        last = finals.argmax(axis=1)
+        rows = np.arange(size)
+        for pos in range(width - 1, -1, -1):
+            # sequences [running:active[pos]] have their last symbol at pos
+            running = active[pos + 1] if pos + 1 < width else 0
+            paths[running:active[pos], pos] = last[running:active[pos]]
+            if running:
+                paths[:running, pos] = pointers[rows[:running], pos + 1,
+                                                paths[:running, pos + 1]]
+        return paths
+
+    def empty_result(self, return_omega=True):
+        """Result for a sequence without any valid symbol."""
+        path = np.zeros(0, dtype=np.int64)
+        likelihood = np.float64(-np.inf)
+        if return_omega:
+            return (path, likelihood, np.zeros(0))
+        return (path, likelihood)
@@ -20,7 +20,8 @@ $(function(){
     if (query_lines.length > 10000) {
       set_message("mdi-action-report-problem",
           "Your input is too long. Please divide them into smaller chunks if possible.\n"
-          + "Or you can use command line tool.",
+          + "Or you can post the whole FASTA file to our API: "
+          + "curl --data-binary @your.fasta http://tenuto.bi.a.u-tokyo.ac.jp/tapp/api/predict",
           true);
     }
 
@@ -49,7 +50,7 @@ $(function(){
     if (Object.keys(queries).length > 50) {
       set_message("mdi-action-report-problem",
           "Too many input sequences (>50). "
-          + "Please divide them or use client tool instead.",
+          + "Please divide them or post them to /tapp/api/predict instead.",
           true);
       return;
     }
@@ -18,6 +18,19 @@ function formatSequences(original, decoded) {
   return formatted;
 }
 
+function decodedPath(result) {
+  // the decoded path of a result, restored from its runs if compact
+  // (see predictor/serialize.py)
+  if (result.path_runs === undefined) {
+    return result.path;
+  }
+  var path = "";
+  for (var i = 0; i < result.path_runs.length; i++) {
+    path += new Array(result.path_runs[i][1] + 1).join(result.path_runs[i][0]);
+  }
+  return path;
+}
+
 $(function () {
   // setup the modal help
   $('.modal-trigger').leanModal();
@@ -38,6 +51,14 @@ $(function () {
     }
   });
 
+  // score is null for a sequence without valid residues
+  function formatScore(score) {
+    if (score === null) {
+      return '-';
+    }
+    return Math.round(score * Math.pow(10, 5)) / Math.pow(10, 5);
+  }
+
   // Directives for Transparency template engine
   var directives_summary = {
     seq_id: {
@@ -57,7 +78,7 @@ $(function () {
     },
     score: {
       text: function(params) {
-        return Math.round(this.score * Math.pow(10, 5)) / Math.pow(10, 5);
+        return formatScore(this.score);
       },
     }
   };
@@ -78,12 +99,12 @@ $(function () {
     },
     score: {
       text: function(params) {
-        return 'Score: ' + Math.round(this.score * Math.pow(10, 5)) / Math.pow(10, 5);
+        return 'Score: ' + formatScore(this.score);
       },
     },
     path: {
       text: function(params) {
-        return formatSequences(this.seq, this.path);
+        return formatSequences(this.seq, decodedPath(this));
       },
     },
     is_ta: {
@@ -96,27 +117,118 @@ $(function () {
 
   // retreieve date before requesting result
   var date_before = new Date();
-  // perform ajax to retrieve prediction result
-  var url = '../predict/' + $('#query_id').text();
-  var predicted = $.getJSON(url)
-    .done(function(data){
-      // if data is null, return.
-      // maybe still under the calculation.
-      if (data === null) {
-        return;
-      }
+  var query_id = $('#query_id').text();
 
-      // retreieve another date
-      var timediff = (new Date() - date_before) / 1000.0;
+  // untouched copies of the templates, to render streamed rows alone
+  var summary_template = $('#result_summary_list').clone();
+  var detail_template = $('#result_detail_list').clone();
 
-      // update status
-      $('#status-text').text('CALCULATION FINISHED');
-      $('#status-progress').text(
-          Object.keys(data).length + ' seqs '
-          + '| took ' + timediff + ' secs');
+  // render the data using Transparency template engine
+  function render(data) {
+    $('#result_summary_list').render(data, directives_summary);
+    $('#result_detail_list').render(data, directives_detail);
+  }
 
-      // render the data using Transparency template engine
-      $('#result_summary_list').render(data, directives_summary);
-      $('#result_detail_list').render(data, directives_detail);
+  // render only the given rows ([index, result]) and insert them in the
+  // order of the query, leaving the rows rendered before untouched
+  var shown = [];  // the indices of the rendered rows, sorted
+  function renderRows(rows) {
+    var data = rows.map(function(row) { return row[1]; });
+    var summaries = summary_template.clone()
+      .render(data, directives_summary).children();
+    var details = detail_template.clone()
+      .render(data, directives_detail).children();
+    var summary_list = $('#result_summary_list')[0];
+    var detail_list = $('#result_detail_list')[0];
+    if (shown.length === 0) {
+      // remove the blank templates
+      $(summary_list).empty();
+      $(detail_list).empty();
+    }
+    rows.forEach(function(row, i) {
+      // the position among the rendered rows, by binary search
+      var low = 0, high = shown.length;
+      while (low < high) {
+        var middle = (low + high) >> 1;
+        if (shown[middle] < row[0]) {
+          low = middle + 1;
+        } else {
+          high = middle;
+        }
+      }
+      shown.splice(low, 0, row[0]);
+      summary_list.insertBefore(summaries[i], summary_list.children[low] || null);
+      detail_list.insertBefore(details[i], detail_list.children[low] || null);
     });
+  }
+
+  function finish(count) {
+    // retreieve another date
+    var timediff = (new Date() - date_before) / 1000.0;
+
+    // update status
+    $('#status-text').text('CALCULATION FINISHED');
+    $('#status-progress').text(
+        count + ' seqs '
+        + '| took ' + timediff + ' secs');
+  }
+
+  // perform ajax to retrieve the whole prediction result at once
+  function fetchAll() {
+    var url = '../predict/' + query_id;
+    $.getJSON(url)
+      .done(function(data){
+        // if data is null, return.
+        // maybe still under the calculation.
+        if (data === null) {
+          return;
+        }
+        finish(Object.keys(data).length);
+        render(data);
+      });
+  }
+
+  // receive the results sequence by sequence, and render them as they arrive
+  function stream() {
+    var url = new URL('../predict/' + query_id + '/stream', window.location.href);
+    url.protocol = (url.protocol === 'https:') ? 'wss:' : 'ws:';
+    var socket = new WebSocket(url.href);
+    var received = false;
+    var finished = false;
+
+    socket.onmessage = function(event) {
+      var message = JSON.parse(event.data);
+      received = true;
+      if (message.error !== undefined) {
+        $('#status-text').text(message.error);
+        return;
+      }
+      if (message.finished) {
+        finished = true;
+        finish(message.total);
+        return;
+      }
+      // show the progress instead of the spinner
+      $('#status-progress .progress > div')
+        .removeClass('indeterminate').addClass('determinate')
+        .css('width', (100.0 * message.done / message.total) + '%');
+      $('#status-text').text('CALCULATING... (' + message.done
+                             + ' / ' + message.total + ')');
+      renderRows(message.results);
+    };
+    socket.onclose = function() {
+      // fall back to a single request if nothing has been streamed
+      if (!received) {
+        fetchAll();
+      } else if (!finished) {
+        $('#status-text').text('CONNECTION LOST. Please reload the page.');
+      }
+    };
+  }
+
+  if (window.WebSocket !== undefined && window.URL !== undefined) {
+    stream();
+  } else {
+    fetchAll();
+  }
 });
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""Views of an IndexedFastaDataSet made by copy() and their merges."""
+
+import copy
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import predictor
+
+DATASET = os.path.join(os.path.dirname(__file__), os.pardir,
+                       'static', 'datasets', 'ta.fasta')
+
+
+class IndexedFastaDataSetTest(unittest.TestCase):
+
+    def setUp(self):
+        # eight records, indexed in a directory of their own
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'eight.fasta')
+        with open(DATASET) as source, open(self.filename, 'w') as f:
+            records = source.read().split('\n>')[:8]
+            f.write('\n>'.join(records) + '\n')
+        self.dataset = predictor.FastaDataSetMaker().open_indexed(self.filename)
+        self.ids = list(self.dataset.identifiers)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_copy_holds_only_its_identifiers(self):
+        subset = self.dataset.copy(self.ids[:2])
+        self.assertIn(self.ids[0], subset)
+        self.assertNotIn(self.ids[5], subset)
+        with self.assertRaises(IndexError):
+            del subset[self.ids[5]]
+        self.assertIn(self.ids[5], self.dataset)
+
+    def test_merge_subsets(self):
+        merged = copy.deepcopy(self.dataset.copy(self.ids[:4]))
+        merged.merge(self.dataset.copy(self.ids[4:]))
+        self.assertEqual(len(merged), 8)
+        self.assertEqual(merged.identifiers, self.ids)
+        for identifier in self.ids:
+            self.assertEqual(merged[identifier].sequence,
+                             self.dataset[identifier].sequence)
+
+    def test_views_do_not_share_records(self):
+        first = self.dataset.copy(self.ids[:4])
+        second = self.dataset.copy(self.ids[:4])
+        first.merge(self.dataset.copy(self.ids[4:]))
+        self.assertEqual(len(second), 4)
+        self.assertNotIn(self.ids[6], second)
+
+
+if __name__ == '__main__':
+    unittest.main()
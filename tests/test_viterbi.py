@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""BatchViterbi compared with the viterbi of predictor.hmm."""
+
+import sys
+import unittest
+
+import numpy as np
+
+import predictor
+import predictor.viterbi as viterbi
+
+# predictor.hmm is rebound by the star imports of predictor
+hmm = sys.modules['predictor.hmm.hmm']
+
+STATES = 6
+SYMBOLS = 4
+
+
+def chain_model():
+    """Return (t, e, i) of a small left-to-right model with a state that
+    emits nothing and a state that cannot start."""
+    rng = np.random.RandomState(1)
+    t = np.zeros((STATES, STATES))
+    for n in range(STATES):
+        t[n, n] = 0.5
+        t[n, (n + 1) % STATES] = 0.3
+        t[n, (n + 3) % STATES] = 0.2 * rng.rand()
+    t /= t.sum(axis=1, keepdims=True)
+    e = rng.rand(STATES, SYMBOLS)
+    e[2, :] = 0.0
+    e /= np.maximum(e.sum(axis=1, keepdims=True), 1.0e-300)
+    i = rng.rand(STATES)
+    i[STATES - 1] = 0.0
+    i /= i.sum()
+    return (t, e, i)
+
+
+class BatchViterbiTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.t, self.e, self.i) = chain_model()
+        self.reference = hmm.HMM(self.t.copy(), self.e.copy(), self.i.copy())
+        rng = np.random.RandomState(2)
+        # lengths of 1 and others mixed, so that buckets hold several
+        self.sequences = [rng.randint(0, SYMBOLS, size=length)
+                          for length in (1, 1, 2, 5, 7, 7, 30, 64)]
+        self.decoders = {
+            'dense': viterbi.BatchViterbi(self.t, self.e, self.i,
+                                          sparse=False),
+            'sparse': viterbi.BatchViterbi(self.t, self.e, self.i,
+                                           sparse=True),
+            'checkpointed': viterbi.BatchViterbi(self.t, self.e, self.i,
+                                                 checkpoint_length=0)}
+
+    def assertSameResult(self, result, expected):
+        (path, likelihood, omega) = result
+        self.assertEqual(list(path), list(expected[0]))
+        self.assertAlmostEqual(likelihood, expected[1])
+        np.testing.assert_allclose(omega, expected[2])
+
+    def test_decode(self):
+        expected = [self.reference.viterbi(sequence, return_omega=True)
+                    for sequence in self.sequences]
+        for name, decoder in self.decoders.items():
+            with self.subTest(decoder=name):
+                results = decoder.decode(self.sequences)
+                self.assertEqual(len(results), len(expected))
+                for result, reference in zip(results, expected):
+                    self.assertSameResult(result, reference)
+
+    def test_decode_without_omega(self):
+        expected = self.decoders['dense'].decode(self.sequences)
+        for name, decoder in self.decoders.items():
+            with self.subTest(decoder=name):
+                results = decoder.decode(self.sequences, return_omega=False)
+                for result, reference in zip(results, expected):
+                    self.assertEqual(len(result), 2)
+                    self.assertEqual(list(result[0]), list(reference[0]))
+                    self.assertEqual(result[1], reference[1])
+
+    def test_zero_emission_state_is_never_decoded(self):
+        for name, decoder in self.decoders.items():
+            with self.subTest(decoder=name):
+                for path, likelihood, omega in decoder.decode(self.sequences):
+                    self.assertNotIn(2, list(path))
+
+    def test_empty_sequence(self):
+        sequences = [np.zeros(0, dtype=np.int64)] + self.sequences[:2]
+        for name, decoder in self.decoders.items():
+            with self.subTest(decoder=name):
+                results = decoder.decode(sequences)
+                (path, likelihood, omega) = results[0]
+                self.assertEqual(len(path), 0)
+                self.assertEqual(likelihood, -np.inf)
+                self.assertEqual(len(omega), 0)
+                self.assertSameResult(
+                        results[1], self.reference.viterbi(
+                            sequences[1], return_omega=True))
+                self.assertEqual(decoder.score(sequences)[0], -np.inf)
+
+    def test_score(self):
+        for name, decoder in self.decoders.items():
+            with self.subTest(decoder=name):
+                likelihoods = decoder.score(self.sequences)
+                for likelihood, sequence in zip(likelihoods, self.sequences):
+                    self.assertAlmostEqual(
+                            likelihood, self.reference.viterbi(sequence)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()